@@ -1,6 +1,8 @@
 import logging
 import multiprocessing as mp
 import os
+import queue as sync_queue
+import time
 import traceback
 from datetime import datetime, timedelta
 from glob import glob
@@ -9,6 +11,7 @@ from logging.handlers import QueueListener
 from os.path import exists, join
 from pathlib import Path
 
+import cv2
 import numpy as np
 
 from multicamera_acquisition.config import (
@@ -16,13 +19,14 @@ from multicamera_acquisition.config import (
     save_config,
     validate_recording_config,
 )
+from multicamera_acquisition.frame_queue import SharedFrameQueue
 from multicamera_acquisition.interfaces.camera_azure import enumerate_azure_cameras
 from multicamera_acquisition.interfaces.camera_base import CameraError, get_camera
 from multicamera_acquisition.interfaces.camera_basler import enumerate_basler_cameras
 from multicamera_acquisition.interfaces.microcontroller import Microcontroller
 from multicamera_acquisition.logging_utils import setup_child_logger
 from multicamera_acquisition.visualization import MultiDisplay
-from multicamera_acquisition.writer import get_writer
+from multicamera_acquisition.writer import assign_cpu_sets, get_writer
 from multicamera_acquisition._version import get_versions
 
 
@@ -43,15 +47,16 @@ class AcquisitionLoop(mp.Process):
         logging_level=logging.DEBUG,
         process_name=None,
         fps=None,
+        display_ready=None,
     ):
         """
         Parameters
         ----------
-        write_queue : multiprocessing.Queue
+        write_queue : SharedFrameQueue
             A queue to which frames will be written.
 
-        display_queue : multiprocessing.Queue
-            A queue from which frames will be read for display.
+        display_queue : SharedFrameQueue
+            A queue to which (downsampled) frames will be sent for display.
 
         camera_device_index : int
             The device index of the camera to acquire from.
@@ -59,7 +64,7 @@ class AcquisitionLoop(mp.Process):
         camera_config : dict
             A config dict for the Camera.
 
-        write_queue_depth : multiprocessing.Queue (default: None)
+        write_queue_depth : SharedFrameQueue (default: None)
             A queue to which depth frames will be written (azure only).
 
         acq_loop_config : dict (default: None)
@@ -81,6 +86,10 @@ class AcquisitionLoop(mp.Process):
             Only used to determine the timeout for the camera.get_array() call.
             If None, the timeout will be set to 1000 ms.
 
+        display_ready : multiprocessing.Event (default: None)
+            An event to set whenever a frame is sent to the display_queue,
+            so that the display can sleep until there's something to show.
+
         """
 
         # Save the process name for logging purposes
@@ -89,6 +98,7 @@ class AcquisitionLoop(mp.Process):
         # Save values
         self.write_queue = write_queue
         self.display_queue = display_queue
+        self.display_ready = display_ready
         self.write_queue_depth = write_queue_depth
         self.camera_config = camera_config
         self.camera_device_index = camera_device_index
@@ -117,6 +127,10 @@ class AcquisitionLoop(mp.Process):
             "downsample": 4,
             "dropped_frame_warnings": False,
             "max_frames_to_acqure": None,
+            "write_queue_slots": 64,
+            # Give up on a writer (and stop acquiring) if it doesn't free a slot in
+            # its queue for this many seconds, e.g. because it has crashed
+            "write_queue_timeout": 10,
         }
 
     def _create_mp_events(self):
@@ -131,6 +145,80 @@ class AcquisitionLoop(mp.Process):
             mp.Event()
         )  #  the main thread can interrupt acquisition by setting this event via the .stop() method.
 
+    def _send_to_display(self, img):
+        """Send a downsampled copy of a frame to the display, unless it has fallen behind."""
+        downsample = self.acq_config["downsample"]
+        shape = (
+            max(img.shape[0] // downsample, 1),
+            max(img.shape[1] // downsample, 1),
+        ) + img.shape[2:]
+        try:
+            buffer = self.display_queue.next_frame_buffer(shape, img.dtype, block=False)
+        except sync_queue.Full:
+            # Skip this frame rather than hold up acquisition
+            return
+
+        # Average over blocks of pixels (taking every n-th pixel instead would alias),
+        # writing the result straight into the display queue's shared memory
+        # (cv2 only writes into dst if it has exactly the output's shape and dtype,
+        # and otherwise silently returns a new array, so check)
+        resized = cv2.resize(
+            img, shape[1::-1], dst=buffer, interpolation=cv2.INTER_AREA
+        )
+        if resized is not buffer:
+            np.copyto(buffer, resized.reshape(buffer.shape))
+        self.display_queue.put_nowait((buffer,))
+        if self.display_ready is not None:
+            self.display_ready.set()
+
+    def _put_frame(self, queue, item):
+        """Put a frame on a write queue, waiting while the writer catches up.
+
+        The wait is bounded, so that a writer that has died can't hang the loop:
+        the frame is dropped if acquisition has been stopped in the meantime, or
+        if the writer frees no slot for write_queue_timeout seconds, in which
+        case acquisition is stopped. Returns whether the frame was queued.
+        """
+        timeout = self.acq_config.get(
+            "write_queue_timeout", self.default_acq_loop_config()["write_queue_timeout"]
+        )
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except sync_queue.Full:
+                pass
+            if self.stopped.is_set():
+                self.logger.warning(
+                    f"Dropped frame {item[3]} ({self.camera_config['name']}): "
+                    "acquisition stopped while waiting for the writer"
+                )
+                return False
+            if time.monotonic() > deadline:
+                self.logger.error(
+                    f"Writer for {self.camera_config['name']} has not taken a frame in "
+                    f"{timeout} s; stopping acquisition"
+                )
+                self.stopped.set()
+                return False
+
+    def _send_stop_signal(self, queue, consumer):
+        """Tell a queue's consumer that no more frames are coming.
+
+        A SharedFrameQueue waits up to its drain_timeout for the consumer to finish
+        with its frames, and raises queue.Full if the consumer has gone away and left
+        the queue full (e.g. the display window was closed). That is logged rather
+        than raised, so that the camera still gets closed.
+        """
+        try:
+            queue.put(tuple())
+        except sync_queue.Full:
+            self.logger.error(
+                f"The {consumer} for {self.camera_config['name']} did not finish "
+                "reading its frames; some may not have been written or shown"
+            )
+
     def _continue_from_main_thread(self):
         """Tell the acquisition loop to continue (called from the main thread)."""
         self.await_main_thread.set()
@@ -292,34 +380,29 @@ class AcquisitionLoop(mp.Process):
 
                         # writer expects (img, line_status, camera_timestamp, self.frames_received),
                         # but Azure has no concept of line_status, so we just pass None.
-                        self.write_queue.put(
-                            tuple([ir, None, camera_timestamp, n_frames_received])
+                        self._put_frame(
+                            self.write_queue,
+                            tuple([ir, None, camera_timestamp, n_frames_received]),
                         )
-                        self.write_queue_depth.put(
-                            tuple([depth, None, camera_timestamp, n_frames_received])
+                        self._put_frame(
+                            self.write_queue_depth,
+                            tuple([depth, None, camera_timestamp, n_frames_received]),
                         )
                         if self.camera_config["display"]["display_frames"]:
-                            if n_frames_received % self.display_every_n == 0:
-                                self.display_queue.put(
-                                    depth[
-                                        :: self.acq_config["downsample"],
-                                        :: self.acq_config["downsample"],
-                                    ],
-                                )
+                            if (
+                                n_frames_received % self.acq_config["display_every_n"]
+                                == 0
+                            ):
+                                self._send_to_display(depth)
                     else:
                         img, linestatus, camera_timestamp = _cam_data
-                        self.write_queue.put((img, linestatus, camera_timestamp, n_frames_received))  # writer exepcts (img, line_status, camera_timestamp, self.frames_received)
+                        self._put_frame(self.write_queue, (img, linestatus, camera_timestamp, n_frames_received))  # writer exepcts (img, line_status, camera_timestamp, self.frames_received)
                         if self.camera_config["display"]["display_frames"]:
                             if (
                                 n_frames_received % self.acq_config["display_every_n"]
                                 == 0
                             ):
-                                self.display_queue.put(
-                                    img[
-                                        :: self.acq_config["downsample"],
-                                        :: self.acq_config["downsample"],
-                                    ]
-                                )
+                                self._send_to_display(img)
 
                     # Check if we dropped any frames
                     delta_t = (camera_timestamp - prev_timestamp) / 1e6
@@ -372,11 +455,13 @@ class AcquisitionLoop(mp.Process):
         self.logger.debug(
             f"Writing empties to stop queue, {self.camera_config['name']}"
         )
-        self.write_queue.put(tuple())
+        self._send_stop_signal(self.write_queue, "writer")
         if self.write_queue_depth is not None:
-            self.write_queue_depth.put(tuple())
+            self._send_stop_signal(self.write_queue_depth, "depth writer")
         if self.display_queue is not None:
-            self.display_queue.put(tuple())
+            self._send_stop_signal(self.display_queue, "display")
+            if self.display_ready is not None:
+                self.display_ready.set()
 
         """ 
         CAMERA CLOSING INFO
@@ -648,6 +733,8 @@ def refactor_acquire_video(
             display_every_n: 4
             dropped_frame_warnings: False
             max_frames_to_acqure: null
+            write_queue_slots: 64
+            write_queue_timeout: 10
         rt_display:
             downsample: 4
             range: [0, 1000]
@@ -813,6 +900,16 @@ def refactor_acquire_video(
     is critical for how the Basler API works on the backend; see https://github.com/basler/pypylon/issues/659#issuecomment-1970761941.)
 
     """
+    # Give each writer that encodes on the CPU its own cores
+    assign_cpu_sets(
+        [
+            camera_dict[key]
+            for camera_dict in final_config["cameras"].values()
+            for key in ["writer", "writer_depth"]
+            if key in camera_dict
+        ]
+    )
+
     # Create the various processes
     # TODO: refactor these into one "running processes" dict or sth like that
     logger.info("Opening subprocesses and cameras, this may take a moment...")
@@ -822,12 +919,20 @@ def refactor_acquire_video(
     camera_list = []
     display_ranges = []
 
+    # Set by the acquisition loops whenever they send a frame to the display
+    display_ready = mp.Event()
+
     try:
         for camera_name, camera_dict in final_config["cameras"].items():
             # Create a writer queue
-            write_queue = (
-                mp.Queue()
-            )  # This queue is used to send frames from the AcuqisitionLoop process to the Writer process
+            # This queue is used to send frames from the AcuqisitionLoop process to the Writer process.
+            # Frames are passed through shared memory, so the number of slots bounds how far
+            # the writer can fall behind before the acquisition loop has to wait for it.
+            write_queue_slots = final_config["acq_loop"].get(
+                "write_queue_slots",
+                AcquisitionLoop.default_acq_loop_config()["write_queue_slots"],
+            )
+            write_queue = SharedFrameQueue(n_slots=write_queue_slots)
 
             # Generate file names
             if append_camera_serial:
@@ -855,7 +960,7 @@ def refactor_acquire_video(
 
             # Get a second writer process for depth if needed
             if camera_dict["brand"] == "azure":
-                write_queue_depth = mp.Queue()
+                write_queue_depth = SharedFrameQueue(n_slots=write_queue_slots)
                 if append_camera_serial:
                     cam_append_str = (
                         f".{camera_dict['name']}_depth.{camera_dict['id']}.avi"
@@ -881,9 +986,10 @@ def refactor_acquire_video(
 
             # Setup display queue for camera if requested
             if camera_dict["display"]["display_frames"] is True:
-                display_queue = (
-                    mp.Queue()
-                )  # This queue is used to send frames from the AcuqisitionLoop process to the MultiDisplay process
+                # This queue is used to send (downsampled) frames from the AcuqisitionLoop process
+                # to the MultiDisplay process, through shared memory. The display is best-effort:
+                # frames are skipped while it's full, and it's given less time to drain at the end.
+                display_queue = SharedFrameQueue(n_slots=4, drain_timeout=5)
                 display_queues.append(display_queue)
                 camera_list.append(camera_name)
                 display_ranges.append(camera_dict["display"]["display_range"])
@@ -902,6 +1008,7 @@ def refactor_acquire_video(
                 logging_level=logging_level,
                 process_name=f"{camera_name}_acqLoop",
                 fps=final_config["globals"]["fps"],
+                display_ready=display_ready,
             )
 
             # Start the writer and acquisition loop processes
@@ -936,6 +1043,7 @@ def refactor_acquire_video(
             config=final_config["rt_display"],
             logger_queue=logger_queue,
             logging_level=logging_level,
+            display_ready=display_ready,
         )
         display_proc.start()
     else:
@@ -0,0 +1,378 @@
+import multiprocessing as mp
+import pickle
+import queue as sync_queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Layout of the ring's counters (in uint64s). The producer's write counter and each
+# consumer's read counter live on separate 64-byte cache lines, after a line of
+# padding, so that no two processes ever write to the same line.
+_CACHE_LINE = 8
+_WRITE = 1 * _CACHE_LINE
+_READ = 2 * _CACHE_LINE  # consumer k's read counter is at _READ + k * _CACHE_LINE
+
+# Per-slot record: [kind, generation, metadata length, metadata sent via control queue]
+_KIND, _GENERATION, _META_LEN, _META_QUEUED = range(4)
+_FRAME, _ITEM = 1, 2
+
+# Polling intervals (sec) when the ring is empty (consumer) or full (producer)
+_MIN_POLL_INTERVAL = 1e-4
+_MAX_POLL_INTERVAL = 5e-3
+
+
+class SharedFrameQueue(object):
+    """A drop-in replacement for multiprocessing.Queue that moves frames
+    through shared memory instead of pickling them through a pipe.
+
+    Items are tuples whose first element is an image, e.g. the
+    (img, line_status, camera_timestamp, frames_received) tuples that
+    the writers expect. The image is copied once into a slot of a
+    shared memory block owned by the producer, and the rest of the tuple
+    is stored in a small per-slot record next to it. Items that don't
+    start with a numpy array (including the empty tuple used as a stop
+    signal) are stored in the record alone.
+
+    Producer and consumer coordinate through a single-producer /
+    single-consumer ring: the producer publishes a write counter and the
+    consumer publishes a read counter, so no locks or pipe writes are
+    needed per frame. The underlying mp.Queue is only used to announce
+    new shared memory blocks and for items too large for a slot record.
+
+    The consumer receives a view into the slot, which stays valid until
+    its next call to get(). Frames must therefore be consumed in order
+    by a single process, and each frame must be finished with (written,
+    copied, etc.) before the next one is fetched.
+
+    Several consumers can read the same stream of frames (e.g. a writer and
+    a display), which are then copied into shared memory only once. Each
+    consumer gets every item, and a slot is only reused once all of them
+    are done with it, so a slow consumer holds up the producer. Use
+    consumer(k) to get the queue to hand to the k-th consumer.
+
+    Parameters
+    ----------
+    n_slots : int (default: 16)
+        The number of frames that can be in flight at once.
+        When all slots are in use, put() blocks until the consumer
+        frees one, which provides backpressure to the producer.
+
+    drain_timeout : float (default: 60)
+        When the producer puts the stop signal (an empty tuple), it waits up to
+        this many seconds for the consumer to finish with all outstanding frames
+        before releasing the shared memory.
+
+    batch_size : int (default: 1)
+        Only publish the producer's write counter every batch_size frames,
+        trading latency for fewer writes to the shared cache line.
+        Non-frame items (e.g. the stop signal) are always published immediately.
+
+    meta_bytes : int (default: 256)
+        The size of each slot's record for the (pickled) rest of the tuple.
+        Larger items are sent through the mp.Queue instead.
+
+    n_consumers : int (default: 1)
+        The number of consumers that each read every item.
+        The queue itself is consumer 0.
+    """
+
+    def __init__(
+        self, n_slots=16, drain_timeout=60, batch_size=1, meta_bytes=256, n_consumers=1
+    ):
+        if n_slots < 1:
+            raise ValueError("n_slots must be at least 1")
+        if batch_size < 1 or batch_size > n_slots:
+            raise ValueError("batch_size must be between 1 and n_slots")
+        if n_consumers < 1:
+            raise ValueError("n_consumers must be at least 1")
+        self.n_slots = n_slots
+        self.drain_timeout = drain_timeout
+        self.batch_size = batch_size
+        self.meta_bytes = meta_bytes
+        self.n_consumers = n_consumers
+        self.consumer_index = 0
+
+        # Shared between processes
+        # (each consumer has its own control queue, since they all need every message)
+        self._controls = [mp.Queue() for _ in range(n_consumers)]
+        self._counters = mp.RawArray("Q", (2 + n_consumers) * _CACHE_LINE)
+        self._slot_info = mp.RawArray("Q", n_slots * 4)
+        self._slot_meta = mp.RawArray("B", n_slots * meta_bytes)
+
+        self._init_local_state()
+
+    def __getstate__(self):
+        # Only the shared pieces travel to child processes;
+        # each process sets up its own producer / consumer state.
+        return {
+            "n_slots": self.n_slots,
+            "drain_timeout": self.drain_timeout,
+            "batch_size": self.batch_size,
+            "meta_bytes": self.meta_bytes,
+            "n_consumers": self.n_consumers,
+            "consumer_index": self.consumer_index,
+            "_controls": self._controls,
+            "_counters": self._counters,
+            "_slot_info": self._slot_info,
+            "_slot_meta": self._slot_meta,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_local_state()
+
+    def consumer(self, k):
+        """Get a handle on this queue for the k-th consumer (0 is the queue itself)."""
+        if not 0 <= k < self.n_consumers:
+            raise ValueError(f"consumer must be between 0 and {self.n_consumers - 1}")
+        state = self.__getstate__()
+        state["consumer_index"] = k
+        handle = SharedFrameQueue.__new__(SharedFrameQueue)
+        handle.__setstate__(state)
+        return handle
+
+    def _init_local_state(self):
+        self._counters_view = np.frombuffer(self._counters, dtype=np.uint64)
+        self._read_counters = self._counters_view[_READ::_CACHE_LINE][
+            : self.n_consumers
+        ]
+        self._read = _READ + self.consumer_index * _CACHE_LINE
+        self._control = self._controls[self.consumer_index]
+        self._info_view = np.frombuffer(self._slot_info, dtype=np.uint64).reshape(
+            (self.n_slots, 4)
+        )
+        self._meta_view = np.frombuffer(self._slot_meta, dtype=np.uint8).reshape(
+            (self.n_slots, self.meta_bytes)
+        )
+
+        # Producer-side state
+        self._shm = None
+        self._slots = None
+        self._next_buffer = None
+        self._retired = []
+        self._generation = 0
+        self._write_idx = 0
+        self._local_read = 0
+
+        # Consumer-side state
+        self._attached = None
+        self._attached_generation = 0
+        self._frames = None
+        self._read_idx = 0
+        self._local_write = 0
+        self._holding_slot = False
+
+    @staticmethod
+    def _poll(condition, block, timeout):
+        """Wait for condition() to be true, with exponential backoff. Returns False on timeout."""
+        if condition():
+            return True
+        if not block:
+            return False
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        interval = _MIN_POLL_INTERVAL
+        while not condition():
+            if deadline is not None and time.perf_counter() >= deadline:
+                return False
+            time.sleep(interval)
+            interval = min(interval * 2, _MAX_POLL_INTERVAL)
+        return True
+
+    # Producer side
+
+    def _slot_is_free(self):
+        if self._write_idx - self._local_read < self.n_slots:
+            return True
+        # Only look at the consumers' cache lines when we appear to be full
+        self._local_read = int(self._read_counters.min())
+        return self._write_idx - self._local_read < self.n_slots
+
+    def _ensure_buffer(self, shape, dtype):
+        """Allocate (or re-allocate, if the frame format changed) the shared memory slots."""
+        if (
+            self._slots is not None
+            and self._slots.shape[1:] == shape
+            and self._slots.dtype == dtype
+        ):
+            return
+
+        # Frames from the old block may still be in flight, so keep it until we're done
+        if self._shm is not None:
+            self._retired.append(self._shm)
+            self._slots = None
+            self._next_buffer = None
+
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=max(frame_bytes * self.n_slots, 1)
+        )
+        self._slots = np.ndarray(
+            (self.n_slots, *shape), dtype=dtype, buffer=self._shm.buf
+        )
+        self._generation += 1
+        for control in self._controls:
+            control.put((self._generation, self._shm.name, shape, np.dtype(dtype).str))
+
+    def next_frame_buffer(self, shape, dtype, block=True, timeout=None):
+        """Get the shared memory slot that the next frame will occupy, so that the
+        producer can fill it in place. Passing the returned array as the image
+        to the next put() skips the copy into shared memory.
+        """
+        if not self._poll(self._slot_is_free, block, timeout):
+            raise sync_queue.Full
+        self._ensure_buffer(tuple(shape), np.dtype(dtype))
+        self._next_buffer = self._slots[self._write_idx % self.n_slots]
+        return self._next_buffer
+
+    def put(self, obj, block=True, timeout=None):
+        is_stop = isinstance(obj, tuple) and len(obj) == 0
+        if is_stop and timeout is None:
+            # Don't hang forever on the stop signal if the consumer has gone away
+            timeout = self.drain_timeout
+        if not self._poll(self._slot_is_free, block, timeout):
+            if is_stop:
+                self._release_buffers(wait=False)
+            raise sync_queue.Full
+
+        slot = self._write_idx % self.n_slots
+        info = self._info_view[slot]
+        is_frame = (
+            isinstance(obj, tuple) and len(obj) > 0 and isinstance(obj[0], np.ndarray)
+        )
+        if is_frame:
+            img = obj[0]
+            self._ensure_buffer(img.shape, img.dtype)
+            if img is not self._next_buffer:
+                np.copyto(self._slots[slot], img)
+            self._next_buffer = None
+            info[_KIND] = _FRAME
+            info[_GENERATION] = self._generation
+            meta = obj[1:]
+        else:
+            info[_KIND] = _ITEM
+            meta = obj
+
+        meta = pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(meta) <= self.meta_bytes:
+            self._meta_view[slot, : len(meta)] = np.frombuffer(meta, dtype=np.uint8)
+            info[_META_LEN] = len(meta)
+            info[_META_QUEUED] = 0
+        else:
+            for control in self._controls:
+                control.put(meta)
+            info[_META_QUEUED] = 1
+
+        # Publish. (Slot contents are written before the counter, and the consumer
+        # only reads a slot once it sees the counter move past it.)
+        self._write_idx += 1
+        if not is_frame or self._write_idx % self.batch_size == 0:
+            self._counters_view[_WRITE] = self._write_idx
+
+        if is_stop:
+            self._release_buffers()
+
+    def put_nowait(self, obj):
+        return self.put(obj, block=False)
+
+    def _release_buffers(self, wait=True):
+        """Wait for the consumers to finish with all frames, then free the shared memory."""
+        if self._shm is None:
+            return
+
+        def drained():
+            return int(self._read_counters.min()) >= self._write_idx
+
+        if wait:
+            self._poll(drained, True, self.drain_timeout)
+
+        self._slots = None
+        self._next_buffer = None
+        for shm in self._retired + [self._shm]:
+            try:
+                shm.close()
+            except BufferError:
+                pass
+            shm.unlink()
+        self._shm = None
+        self._retired = []
+
+    # Consumer side
+
+    def _item_is_ready(self):
+        if self._read_idx < self._local_write:
+            return True
+        # Only look at the producer's cache line when we appear to be empty
+        self._local_write = int(self._counters_view[_WRITE])
+        return self._read_idx < self._local_write
+
+    def _release_held_slot(self):
+        if self._holding_slot:
+            self._holding_slot = False
+            self._counters_view[self._read] = self._read_idx
+
+    def _attach(self, generation):
+        """Attach to the producer's shared memory block for the given generation."""
+        while self._attached_generation < generation:
+            self._attached_generation, name, shape, dtype = self._control.get()
+
+        self._detach()
+        # (Attaching registers the block with the resource tracker again, but processes
+        # started by multiprocessing all share one tracker, which keeps a set of names,
+        # so it's still only unregistered once, when the producer unlinks it.)
+        shm = shared_memory.SharedMemory(name=name)
+        self._attached = shm
+        self._frames = np.ndarray(
+            (self.n_slots, *shape), dtype=np.dtype(dtype), buffer=shm.buf
+        )
+
+    def _detach(self):
+        """Drop the current shared memory mapping."""
+        self._frames = None
+        if self._attached is not None:
+            try:
+                self._attached.close()
+            except BufferError:
+                pass  # the caller still holds a view; the mapping goes away with the process
+            self._attached = None
+
+    def get(self, block=True, timeout=None):
+        # The previous frame's view is no longer in use, so hand its slot back
+        self._release_held_slot()
+
+        if not self._poll(self._item_is_ready, block, timeout):
+            raise sync_queue.Empty
+
+        slot = self._read_idx % self.n_slots
+        kind, generation, meta_len, meta_queued = (
+            int(v) for v in self._info_view[slot]
+        )
+        if kind == _FRAME and generation != self._attached_generation:
+            self._attach(generation)
+
+        if meta_queued:
+            meta = pickle.loads(self._control.get())
+        else:
+            meta = pickle.loads(self._meta_view[slot, :meta_len].tobytes())
+
+        self._read_idx += 1
+        if kind == _FRAME:
+            self._holding_slot = True
+            return (self._frames[slot], *meta)
+
+        self._counters_view[self._read] = self._read_idx
+        if isinstance(meta, tuple) and len(meta) == 0:
+            self._detach()
+        return meta
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        """The number of items this consumer has yet to fetch."""
+        # (the consumer's published read counter lags by one while it holds a frame)
+        read_idx = max(int(self._counters_view[self._read]), self._read_idx)
+        return max(int(self._counters_view[_WRITE]) - read_idx, 0)
+
+    def empty(self):
+        return self.qsize() == 0
@@ -47,6 +47,9 @@ class BaslerCamera(BaseCamera):
         # Init the parent class
         super().__init__(id=id, name=name, config=config, fps=fps)
 
+        # Trigger mode most recently sent to the camera (see set_trigger_mode())
+        self._trigger_mode = None
+
         # Create the camera object
         self._create_pylon_sys()  # init the pylon API software layer
 
@@ -111,11 +114,13 @@ class BaslerCamera(BaseCamera):
         return config
 
     @staticmethod
-    def default_writer_config(fps, writer_type="ffmpeg", gpu=None):
+    def default_writer_config(fps, writer_type="ffmpeg", gpu="auto"):
         if writer_type == "nvc" and gpu is not None:
             from multicamera_acquisition.writer import NVC_Writer
 
-            writer_config = NVC_Writer.default_writer_config(fps, gpu=gpu).copy()
+            writer_config = NVC_Writer.default_writer_config(
+                fps, gpu=0 if gpu == "auto" else gpu
+            ).copy()
         elif writer_type == "ffmpeg":
             from multicamera_acquisition.writer import FFMPEG_Writer
 
@@ -255,6 +260,7 @@ class BaslerCamera(BaseCamera):
         # Reset to default settings, for safety (i.e. if user was messing around with the camera and didn't reset the settings)
         self.cam.UserSetSelector.Value = "Default"
         self.cam.UserSetLoad.Execute()
+        self._trigger_mode = None  # the user set load resets the trigger settings
 
         # Check the config file for any missing or conflicting params
         assert hasattr(
@@ -281,6 +287,10 @@ class BaslerCamera(BaseCamera):
         # Set gamma
         self.cam.Gamma.SetValue(self.config["gamma"])
 
+        # Deliver 8-bit frames, which is what the writers encode,
+        # so that grabbed frames never need converting
+        self.cam.PixelFormat.SetValue("Mono8")
+
         # Set exposure time
         self.cam.ExposureAuto.SetValue("Off")
         self.cam.ExposureTime.SetValue(self.config["exposure"])
@@ -340,7 +350,13 @@ class BaslerCamera(BaseCamera):
             The trigger mode to use.  Must be one of:
                 - 'microcontroller': use the microcontroller trigger
                 - 'no_trigger': acquire continuously without requiring a trigger.
+
+        Each node write is a round-trip to the camera, so if the camera is already
+        in the requested mode (at the same fps), this is a no-op.
         """
+        if self._trigger_mode == (mode, self.fps):
+            return
+
         if mode == "microcontroller":
             self.cam.AcquisitionMode.SetValue("Continuous")
             self.cam.TriggerMode.SetValue("Off")
@@ -362,6 +378,8 @@ class BaslerCamera(BaseCamera):
         else:
             raise ValueError("Trigger mode must be 'arduino' or 'no_trigger'")
 
+        self._trigger_mode = (mode, self.fps)
+
     def start(self):
         "Start recording images."
         self.cam.StartGrabbing(pylon.GrabStrategy_OneByOne)
@@ -435,7 +453,9 @@ class BaslerCamera(BaseCamera):
         line_status = None
 
         if img.GrabSucceeded():
-            img_array = img.Array.astype(np.uint8)
+            # (Array is already a copy of the grab buffer, so it outlives img.Release(),
+            # and the camera is set to Mono8, so this cast doesn't copy it again)
+            img_array = img.Array.astype(np.uint8, copy=False)
             if get_linestatus:
                 line_status = img.ChunkLineStatusAll.Value
             if get_timestamp:
@@ -0,0 +1,10 @@
+def drain_lines(stream, lines):
+    """Read a (binary) stream line by line until it closes, appending each line to lines.
+
+    Run this on a thread to read a subprocess's stderr, so that the pipe can never
+    fill up and stall the subprocess. Passing a collections.deque with a maxlen
+    as lines keeps only the last few lines.
+    """
+    with stream:
+        for line in stream:
+            lines.append(line.decode(errors="replace").rstrip())
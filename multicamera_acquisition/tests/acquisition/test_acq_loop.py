@@ -1,11 +1,14 @@
 # from ..writer.test_writers import nvc_writer_processes, n_test_frames
 
+import logging
 import multiprocessing as mp
 import time
 
+import numpy as np
 import pytest
 
 from multicamera_acquisition.acquisition import AcquisitionLoop
+from multicamera_acquisition.frame_queue import SharedFrameQueue
 from multicamera_acquisition.interfaces.camera_basler import BaslerCamera
 from multicamera_acquisition.tests.acquisition.test_acq_video import (
     writer_type,
@@ -32,6 +35,85 @@ def test_acq_loop_init(fps):
     assert isinstance(loop.await_main_thread, mp.synchronize.Event)
 
 
+def test_send_to_display():
+    display_queue = SharedFrameQueue(n_slots=2, drain_timeout=1)
+    display_ready = mp.Event()
+    loop = AcquisitionLoop(
+        write_queue=mp.Queue(),
+        display_queue=display_queue,
+        camera_device_index=None,
+        camera_config=BaslerCamera.default_camera_config().copy(),
+        display_ready=display_ready,
+    )
+
+    # Frames are downsampled by averaging blocks of pixels
+    img = np.zeros((8, 12), dtype=np.uint8)
+    img[::2, ::2] = 200  # (which every-n-th-pixel subsampling would turn all white)
+    for _ in range(3):
+        loop._send_to_display(img)
+    assert display_ready.is_set()
+    (frame,) = display_queue.get(timeout=1)
+    assert frame.shape == (2, 3)
+    assert np.all(frame == 50)
+
+    # Frames were dropped once the queue was full, rather than blocking
+    display_queue.get(timeout=1)
+    assert display_queue.empty()
+    display_queue.put(())
+
+
+def test_send_to_display_color():
+    """Multi-channel frames are downsampled into the display queue too."""
+    display_queue = SharedFrameQueue(n_slots=2, drain_timeout=1)
+    loop = AcquisitionLoop(
+        write_queue=mp.Queue(),
+        display_queue=display_queue,
+        camera_device_index=None,
+        camera_config=BaslerCamera.default_camera_config().copy(),
+    )
+
+    img = np.zeros((8, 12, 3), dtype=np.uint8)
+    img[..., 2] = 200
+    loop._send_to_display(img)
+    (frame,) = display_queue.get(timeout=1)
+    assert frame.shape == (2, 3, 3)
+    assert np.all(frame[..., 2] == 200) and np.all(frame[..., :2] == 0)
+    display_queue.put(())
+
+
+def test_put_frame_gives_up_on_stalled_writer(caplog):
+    """If the writer stops taking frames, the loop stops instead of hanging."""
+    write_queue = SharedFrameQueue(n_slots=1, drain_timeout=0.1)
+    acq_config = AcquisitionLoop.default_acq_loop_config().copy()
+    acq_config["write_queue_timeout"] = 0.5
+    camera_config = BaslerCamera.default_camera_config().copy()
+    camera_config["name"] = "test"
+    loop = AcquisitionLoop(
+        write_queue=write_queue,
+        display_queue=None,
+        camera_device_index=None,
+        camera_config=camera_config,
+        acq_loop_config=acq_config,
+    )
+    loop.logger = logging.getLogger()
+
+    frame = np.zeros((4, 4), dtype=np.uint8)
+    assert loop._put_frame(write_queue, (frame, None, 0, 1))
+    assert not loop.stopped.is_set()
+
+    # Nobody is reading, so the ring stays full
+    start = time.monotonic()
+    assert not loop._put_frame(write_queue, (frame, None, 0, 2))
+    assert time.monotonic() - start < 5
+    assert loop.stopped.is_set()
+    assert "has not taken a frame" in caplog.text
+
+    # The stop signal can't be delivered either, which is logged rather than raised
+    # (and the shared memory is still released)
+    loop._send_stop_signal(write_queue, "writer")
+    assert "did not finish reading its frames" in caplog.text
+
+
 def test_acq_loop(tmp_path, fps, n_test_frames, camera_type, writer_type):
     """Test the whole darn thing!"""
 
@@ -22,7 +22,7 @@ def camera_type(pytestconfig):
     return pytestconfig.getoption("camera_type")  # default emulated, see conftest.py
 
 
-@pytest.fixture(scope="function")
+@pytest.fixture(scope="session")
 def camera_brand(camera_type):
     if camera_type == "basler_camera":
         brand = "basler"
@@ -0,0 +1,165 @@
+import av
+import numpy as np
+import pytest
+
+from multicamera_acquisition.video_utils import (
+    count_frames,
+    count_frames_mp4,
+    read_frames,
+)
+
+
+N_FRAMES = 10
+FRAME_SIZE = (64, 48)  # w x h
+
+
+@pytest.fixture(scope="module")
+def depth_video(tmp_path_factory):
+    """Write a short, lossless gray16 video whose frame i is filled with i * 1000."""
+    file_name = str(tmp_path_factory.mktemp("videos") / "depth.avi")
+    with av.open(file_name, mode="w") as container:
+        stream = container.add_stream("ffv1", rate=30)
+        stream.pix_fmt = "gray16le"
+        stream.width, stream.height = FRAME_SIZE
+        for i in range(N_FRAMES):
+            img = np.full(FRAME_SIZE[::-1], i * 1000, dtype=np.uint16)
+            frame = av.VideoFrame.from_ndarray(img, format="gray16le")
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return file_name
+
+
+def test_count_frames(depth_video, tmp_path):
+    assert count_frames(depth_video) == N_FRAMES
+
+    # A changed file is re-counted
+    copy = tmp_path / "copy.avi"
+    with open(depth_video, "rb") as f:
+        copy.write_bytes(f.read())
+    assert count_frames(str(copy)) == N_FRAMES
+    with av.open(str(copy), mode="w") as container:
+        stream = container.add_stream("ffv1", rate=30)
+        stream.pix_fmt = "gray16le"
+        stream.width, stream.height = FRAME_SIZE
+        frame = av.VideoFrame.from_ndarray(
+            np.zeros(FRAME_SIZE[::-1], dtype=np.uint16), format="gray16le"
+        )
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    assert count_frames(str(copy)) == 1
+
+
+@pytest.mark.parametrize("movflags", [None, "frag_keyframe+empty_moov"])
+def test_count_frames_mp4(tmp_path, movflags):
+    file_name = str(tmp_path / "test.mp4")
+    options = {} if movflags is None else {"movflags": movflags}
+    with av.open(file_name, mode="w", options=options) as container:
+        stream = container.add_stream("libx264", rate=30)
+        stream.pix_fmt = "yuv420p"
+        stream.width, stream.height = FRAME_SIZE
+        for i in range(N_FRAMES):
+            frame = av.VideoFrame.from_ndarray(
+                np.full(FRAME_SIZE[::-1], i * 10, dtype=np.uint8), format="gray"
+            )
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+    # (PyAV can't count the frames in fragmented MP4s)
+    assert count_frames_mp4(file_name) == N_FRAMES
+    assert count_frames(file_name) == N_FRAMES
+
+
+@pytest.mark.parametrize("suffix", [".mkv", ".nut"])
+def test_count_frames_without_header_count(tmp_path, suffix):
+    # These containers don't store the number of frames, so the packets are counted
+    file_name = str(tmp_path / f"test{suffix}")
+    with av.open(file_name, mode="w") as container:
+        stream = container.add_stream("ffv1", rate=30)
+        stream.pix_fmt = "gray"
+        stream.width, stream.height = FRAME_SIZE
+        for i in range(N_FRAMES):
+            frame = av.VideoFrame.from_ndarray(
+                np.full(FRAME_SIZE[::-1], i, dtype=np.uint8), format="gray"
+            )
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    assert count_frames(file_name) == N_FRAMES
+
+
+def test_read_frames(depth_video):
+    frames = read_frames(
+        depth_video,
+        list(range(N_FRAMES)),
+        pixel_format="gray16",
+        frame_size=FRAME_SIZE,
+    )
+    assert frames.dtype == np.uint16
+    assert frames.shape == (N_FRAMES, FRAME_SIZE[1], FRAME_SIZE[0])
+    assert np.array_equal(frames[:, 0, 0], np.arange(N_FRAMES) * 1000)
+
+    # By default, frames are read as gray16, so 16-bit data isn't truncated
+    default_frames = read_frames(
+        depth_video, list(range(N_FRAMES)), frame_size=FRAME_SIZE
+    )
+    assert default_frames.dtype == np.uint16
+    assert np.array_equal(default_frames, frames)
+
+    # gray8 output is read as uint8
+    frames = read_frames(
+        depth_video,
+        list(range(N_FRAMES)),
+        pixel_format="gray8",
+        frame_size=FRAME_SIZE,
+    )
+    assert frames.dtype == np.uint8
+    assert frames.shape == (N_FRAMES, FRAME_SIZE[1], FRAME_SIZE[0])
+
+    # Only the frames that exist are returned
+    frames = read_frames(
+        depth_video,
+        list(range(N_FRAMES + 5)),
+        pixel_format="gray16",
+        frame_size=FRAME_SIZE,
+    )
+    assert len(frames) == N_FRAMES
+
+
+def test_read_frames_seek(tmp_path):
+    """Reading from the middle of a group of pictures gives exactly the requested frames."""
+    file_name = str(tmp_path / "test.mp4")
+    n_frames = 100
+    with av.open(file_name, mode="w") as container:
+        stream = container.add_stream("libx264", rate=30, options={"g": "25"})
+        stream.pix_fmt = "yuv420p"
+        stream.width, stream.height = FRAME_SIZE
+        for i in range(n_frames):
+            frame = av.VideoFrame.from_ndarray(
+                np.full(FRAME_SIZE[::-1], i * 2, dtype=np.uint8), format="gray"
+            )
+            frame.pts = i
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+
+    all_frames = read_frames(file_name, list(range(n_frames)), frame_size=FRAME_SIZE)
+    frames = read_frames(file_name, [37, 38, 39], frame_size=FRAME_SIZE)
+    assert np.array_equal(frames, all_frames[37:40])
+
+
+def test_read_frames_gpu_command():
+    command = read_frames("test.mp4", [0, 1], gpu=1, get_cmd=True)
+    assert command.index("-hwaccel") < command.index("-i")
+    assert command[command.index("-hwaccel_device") + 1] == "1"
+    assert "hwdownload,format=nv12" in command
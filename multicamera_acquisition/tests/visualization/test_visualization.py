@@ -1,20 +1,13 @@
-import multiprocessing as mp
-import pdb
-import time
-from pathlib import Path
-
 import cv2
 import numpy as np
-import os
 import pytest
-import matplotlib.pyplot as plt
-import sys
-
-import pdb
 
+from multicamera_acquisition.frame_queue import SharedFrameQueue
 from multicamera_acquisition.visualization import (
     MultiDisplay,
+    format_frame,
     load_first_frames,
+    normalize_array,
     plot_image_grid,
 )
 
@@ -50,7 +43,7 @@ from multicamera_acquisition.writer import (
 def multidisplay_processes(fps, n_test_frames):
     """Generate linked MultiDisplay and DummyFrames processes for testing"""
     config = MultiDisplay.default_MultiDisplay_config().copy()
-    queues = [mp.Queue() for _ in range(2)]
+    queues = [SharedFrameQueue() for _ in range(2)]
     dummy_frames_procs = [
         get_DummyFrames_process(fps, queue, n_test_frames) for queue in queues
     ]
@@ -166,6 +159,7 @@ def test_displayRange(tmp_path, camera_brand, n_test_frames, fps):
 
 def test_image_grid(tmp_path, camera_brand, fps):
     """Run an acquisition and display its first frames in a grid"""
+    import matplotlib.pyplot as plt
 
     n_test_frames = 5
     full_config = create_twocam_config(
@@ -193,3 +187,114 @@ def test_image_grid(tmp_path, camera_brand, fps):
     )
     plt.show(block=False)
     plt.close()
+
+
+@pytest.mark.parametrize(
+    "dtype, display_range",
+    [
+        (np.uint8, (0, 255)),
+        (np.uint8, (100, 200)),
+        (np.uint16, (0, 255)),
+        (np.uint16, (100, 4000)),
+    ],
+)
+def test_format_frame(dtype, display_range):
+    """Frames are scaled to the display range just as normalize_array() scales them."""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, np.iinfo(dtype).max, size=(300, 300), dtype=dtype)
+    expected = normalize_array(frame.copy(), *display_range)
+
+    formatted = format_frame(frame, (300, 300), display_range, is_depth=False)
+    assert np.array_equal(np.asarray(formatted), expected)
+
+
+def test_format_frame_fractional_range():
+    """The lookup table path and the normalize_array path agree for any range."""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 5000, size=(300, 300), dtype=np.uint16)
+    display_range = (100.5, 4000.25)
+
+    formatted = format_frame(frame, (300, 300), display_range, is_depth=False)
+    reference = format_frame(
+        frame.astype(np.float32), (300, 300), display_range, is_depth=False
+    )
+    assert np.array_equal(np.asarray(formatted), np.asarray(reference))
+
+
+def test_format_frame_depth():
+    """Depth frames are colored just as cv2.applyColorMap() colors the normalized frame,
+    in RGB order (OpenCV's colormaps are BGR)."""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 65535, size=(300, 300), dtype=np.uint16)
+    expected = cv2.applyColorMap(normalize_array(frame, 100, 4000), cv2.COLORMAP_TURBO)
+    expected = cv2.cvtColor(expected, cv2.COLOR_BGR2RGB)
+
+    formatted = format_frame(frame, (300, 300), (100, 4000), is_depth=True)
+    assert np.array_equal(np.asarray(formatted), expected)
+
+
+@pytest.mark.parametrize("is_depth", [False, True])
+def test_format_frame_enlarged(is_depth):
+    """Enlarged frames look just as if they were resized before normalizing."""
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 5000, size=(75, 120), dtype=np.uint16)
+    resized = cv2.resize(frame, (300, 300), interpolation=cv2.INTER_NEAREST)
+    expected = format_frame(resized, (300, 300), (100, 4000), is_depth=is_depth)
+
+    formatted = format_frame(frame, (300, 300), (100, 4000), is_depth=is_depth)
+    assert np.array_equal(np.asarray(formatted), np.asarray(expected))
+
+
+def test_normalize_array():
+    """Values are scaled to uint8 and clipped to the range, without modifying the input."""
+    frame = np.array([[0, 50, 100, 200, 300, 1000]], dtype=np.uint16)
+    original = frame.copy()
+
+    normalized = normalize_array(frame, 100, 300)
+    assert normalized.dtype == np.uint8
+    assert np.array_equal(frame, original)
+    assert normalized[0, :3].tolist() == [0, 0, 0]
+    assert abs(int(normalized[0, 3]) - 128) <= 1
+    assert normalized[0, 4:].tolist() == [255, 255]
+
+    # Without a range, the frame's own min and max are used
+    normalized = normalize_array(frame.astype(np.int64))
+    assert normalized[0, 0] == 0 and normalized[0, -1] == 255
+
+
+def test_fetch_image_skips_to_latest():
+    """The display skips ahead to the newest frame, but stops at the stop signal."""
+    queue = SharedFrameQueue(n_slots=16, drain_timeout=0.1)
+    display = MultiDisplay([queue], ["test"], [None])
+    assert display._fetch_image(queue, "test", log_if_error=False) == [None]
+    assert display._fetch_image(queue, "test", False, block=False) == [None]
+
+    for i in range(3):
+        queue.put((np.full((4, 4), i, dtype=np.uint8), None, i, i))
+    img, _, _, frames_received = display._fetch_image(queue, "test", False)
+    assert frames_received == 2
+    assert (img == 2).all()
+
+    # A long backlog is skipped through a bounded number of frames at a time
+    for i in range(3, 15):
+        queue.put((np.full((4, 4), i, dtype=np.uint8), None, i, i))
+    assert display._fetch_image(queue, "test", False)[3] == 11
+    assert display._fetch_image(queue, "test", False)[3] == 14
+
+    queue.put(())
+    assert display._fetch_image(queue, "test", False) == ()
+
+
+def test_normalize_array_multichannel():
+    """Multi-channel frames (e.g. BGR frames from load_first_frames) are clipped
+    and scaled in every channel."""
+    frame = np.full((4, 4, 3), 10, dtype=np.uint8)
+    assert (normalize_array(frame, 50, 200) == 0).all()
+
+    frame[0, 0] = [0, 100, 200]
+    normalized = normalize_array(frame)
+    assert normalized.shape == (4, 4, 3)
+    assert normalized[0, 0].tolist() == [0, 128, 255]
+
+    formatted = format_frame(frame, (4, 4), None, is_depth=False)
+    assert np.asarray(formatted).shape == (4, 4, 3)
@@ -0,0 +1,149 @@
+import multiprocessing as mp
+import queue as sync_queue
+
+import numpy as np
+import pytest
+
+from multicamera_acquisition.frame_queue import SharedFrameQueue
+
+
+def test_round_trip():
+    queue = SharedFrameQueue(n_slots=4, drain_timeout=0.1)
+    frames = [np.full((8, 6), i, dtype=np.uint8) for i in range(3)]
+    for i, frame in enumerate(frames):
+        queue.put((frame, None, i * 0.033, i))
+
+    for i, frame in enumerate(frames):
+        img, line_status, camera_timestamp, frames_received = queue.get(timeout=1)
+        assert np.array_equal(img, frame)
+        assert line_status is None
+        assert camera_timestamp == i * 0.033
+        assert frames_received == i
+
+    queue.put(())
+    assert queue.get(timeout=1) == ()
+
+
+def test_non_frame_items_pass_through():
+    queue = SharedFrameQueue(n_slots=1)
+    queue.put(("not", "a", "frame"))
+    assert queue.get(timeout=1) == ("not", "a", "frame")
+
+
+def test_backpressure():
+    queue = SharedFrameQueue(n_slots=1, drain_timeout=0.1)
+    frame = np.zeros((4, 4), dtype=np.uint16)
+    queue.put((frame, None, 0, 0))
+    with pytest.raises(sync_queue.Full):
+        queue.put_nowait((frame, None, 1, 1))
+
+    # The consumer holds on to the slot until it fetches the next item
+    img, _, _, _ = queue.get(timeout=1)
+    assert img.dtype == np.uint16
+    assert queue.empty()
+    with pytest.raises(sync_queue.Full):
+        queue.put_nowait((frame, None, 1, 1))
+
+    with pytest.raises(sync_queue.Empty):
+        queue.get_nowait()
+    queue.put_nowait((frame, None, 1, 1))
+    queue.get(timeout=1)
+
+    with pytest.raises(sync_queue.Empty):
+        queue.get_nowait()
+    queue.put(())
+
+
+def test_batched_publication_and_large_items():
+    queue = SharedFrameQueue(n_slots=4, drain_timeout=0.1, batch_size=2, meta_bytes=32)
+    frame = np.ones((4, 4), dtype=np.uint8)
+
+    # The first frame isn't visible to the consumer until the batch is full
+    queue.put((frame, None, 0, 0))
+    with pytest.raises(sync_queue.Empty):
+        queue.get_nowait()
+    queue.put((frame, "x" * 100, 1, 1))  # too big for the slot record
+    assert queue.get(timeout=1)[3] == 0
+    assert queue.get(timeout=1)[1] == "x" * 100
+
+    queue.put(())
+    assert queue.get(timeout=1) == ()
+
+
+def test_fill_in_place():
+    queue = SharedFrameQueue(n_slots=2, drain_timeout=0.1)
+    for i in range(3):
+        frame = queue.next_frame_buffer((4, 4), np.uint8)
+        frame.fill(i)
+        queue.put((frame, None, i, i))
+        img, _, _, frames_received = queue.get(timeout=1)
+        assert frames_received == i
+        assert (img == i).all()
+
+    queue.put(())
+    assert queue.get(timeout=1) == ()
+
+
+def test_fan_out():
+    queue = SharedFrameQueue(n_slots=2, drain_timeout=0.1, n_consumers=2)
+    other = queue.consumer(1)
+    frame = np.zeros((4, 4), dtype=np.uint8)
+    for i in range(2):
+        queue.put((frame + i, None, i, i))
+
+    # Both consumers get every frame...
+    for consumer in [queue, other]:
+        for i in range(2):
+            img, _, _, frames_received = consumer.get(timeout=1)
+            assert frames_received == i
+            assert (img == i).all()
+
+    # ...and a slot is only reused once both have moved on from it
+    queue.put_nowait((frame + 2, None, 2, 2))  # the first frame's slot is free
+    with pytest.raises(sync_queue.Full):
+        queue.put_nowait((frame + 3, None, 3, 3))  # both still hold the second frame
+    assert queue.get(timeout=1)[3] == 2
+    with pytest.raises(sync_queue.Full):
+        queue.put_nowait((frame + 3, None, 3, 3))  # the other consumer still holds it
+    assert other.get(timeout=1)[3] == 2
+    queue.put_nowait((frame + 3, None, 3, 3))
+    for consumer in [queue, other]:
+        assert consumer.get(timeout=1)[3] == 3
+
+    queue.put(())
+    for consumer in [queue, other]:
+        assert consumer.get(timeout=1) == ()
+
+
+def _consume(queue, results):
+    """Read frames until the stop signal, reporting the frame number and pixel value of each."""
+    while True:
+        data = queue.get(timeout=10)
+        if len(data) == 0:
+            break
+        img, _, _, frames_received = data
+        results.put((frames_received, int(img[0, 0])))
+    results.put(None)
+
+
+def test_fan_out_across_processes():
+    n_frames = 50
+    queue = SharedFrameQueue(n_slots=4, n_consumers=2)
+    results = [mp.Queue() for _ in range(2)]
+    consumers = [
+        mp.Process(target=_consume, args=(queue.consumer(k), results[k]))
+        for k in range(2)
+    ]
+    for proc in consumers:
+        proc.start()
+
+    for i in range(n_frames):
+        frame = queue.next_frame_buffer((16, 16), np.uint8)
+        frame.fill(i)
+        queue.put((frame, None, i, i))
+    queue.put(())
+
+    for proc, result in zip(consumers, results):
+        received = list(iter(result.get, None))
+        proc.join(timeout=10)
+        assert received == [(i, i) for i in range(n_frames)]
@@ -1,15 +1,24 @@
+import logging
 import multiprocessing as mp
-import pdb
+import os
+import queue as sync_queue
 import time
-from pathlib import Path
 
 import cv2
 import numpy as np
-import os
 import pytest
 
 
-from multicamera_acquisition.writer import FFMPEG_Writer
+from multicamera_acquisition import writer as writer_module
+from multicamera_acquisition.frame_queue import SharedFrameQueue
+from multicamera_acquisition.writer import (
+    FFMPEG_Writer,
+    NVC_Writer,
+    PyAV_Writer,
+    assign_cpu_sets,
+    get_writer,
+    grey2nv12,
+)
 
 from multicamera_acquisition.video_utils import count_frames
 
@@ -24,22 +33,58 @@ def n_test_frames(pytestconfig):
     return int(pytestconfig.getoption("n_test_frames"))
 
 
+def _make_digit_glyphs(font=cv2.FONT_HERSHEY_SIMPLEX, scale=1, thickness=2):
+    """Rasterize the digits 0-9 once, each into a cell of the same size."""
+    sizes = [cv2.getTextSize(str(d), font, scale, thickness) for d in range(10)]
+    # (pad by the stroke thickness, which getTextSize doesn't fully account for)
+    width = max(w for (w, h), baseline in sizes) + 2 * thickness
+    height = max(h + baseline for (w, h), baseline in sizes) + 2 * thickness
+    text_height = max(h for (w, h), baseline in sizes)
+    glyphs = np.zeros((10, height, width), dtype=np.uint8)
+    for d in range(10):
+        origin = (thickness, text_height + thickness)
+        cv2.putText(glyphs[d], str(d), origin, font, scale, 255, thickness)
+    return glyphs
+
+
+_DIGIT_GLYPHS = _make_digit_glyphs()
+
+
+def draw_number(frame, number, x=50, y=30):
+    """Blit the digits of number into frame, with the top left corner at (x, y)."""
+    glyph_h, glyph_w = _DIGIT_GLYPHS.shape[1:]
+    for k, c in enumerate(str(number)):
+        x0 = x + k * glyph_w
+        frame[y : y + glyph_h, x0 : x0 + glyph_w] = _DIGIT_GLYPHS[int(c)]
+
+
 def dummy_frames_func(fps, queue, n_test_frames):
     """A dummy frames function to test the writers.
     Must be separately defined from the get_DummyFrames_process function
     to avoid pickling issues.
     """
     shape = (640, 640)  # 2D image  (must be at least 145 x ? for NVC writer)
-    frame = np.zeros((*shape, 3), dtype=np.uint8)
+
+    # Pace frames against a fixed schedule, so that time spent drawing and
+    # queueing frames doesn't slow the feed below the target fps
+    period = 1 / fps
+    next_frame_time = time.perf_counter()
     for i in range(n_test_frames):
-        frame[:] = 0
-        frame = cv2.putText(
-            frame, str(i), (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2
-        )
+        if isinstance(queue, SharedFrameQueue):
+            # Draw straight into the queue's shared memory
+            frame = queue.next_frame_buffer(shape, np.uint8)
+            frame.fill(0)
+        else:
+            # (mp.Queue pickles frames in a background thread, so they can't be reused)
+            frame = np.zeros(shape, dtype=np.uint8)
+        draw_number(frame, i)
         timestamp = i * 0.033
         n_received = i
-        queue.put((frame[:, :, 0], None, timestamp, n_received))  # writer expects img, line_status, camera_timestamp, self.frames_received
-        time.sleep(1 / fps)
+        queue.put((frame, None, timestamp, n_received))  # writer expects img, line_status, camera_timestamp, self.frames_received
+        next_frame_time += period
+        delay = next_frame_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
     queue.put(())
 
 
@@ -49,79 +94,233 @@ def get_DummyFrames_process(fps, queue, n_test_frames):
     return process
 
 
-@pytest.fixture(scope="function")
-def nvc_writer_processes(tmp_path, fps, n_test_frames):
-    """Generate linked NVC_Writer and DummyFrames processes for testing"""
-    from multicamera_acquisition.writer import NVC_Writer
+# Seconds to wait for each process to finish, beyond the time it takes to feed the frames
+# (the NVC writer also has to remux its video when it's done)
+JOIN_MARGINS = {"nvc": 60, "ffmpeg": 5, "pyav": 5}
+
 
-    config = NVC_Writer.default_writer_config(fps).copy()
+@pytest.fixture(
+    scope="function",
+    params=["nvc", "ffmpeg", "ffmpeg_fragmented", "pyav", "pyav_fragmented"],
+)
+def writer_processes(request, tmp_path, fps, n_test_frames):
+    """Generate linked Writer and DummyFrames processes for testing, for each type of writer"""
+    writer_type, _, fragmented = request.param.partition("_")
+    if writer_type == "nvc":
+        # Make sure NVC is installed, else report test not run
+        try:
+            import PyNvCodec as nvc
+        except ImportError:
+            pytest.skip("PyNvCodec not installed, skipping NVC_Writer test")
+        config = NVC_Writer.default_writer_config(fps).copy()
+    elif writer_type == "ffmpeg":
+        config = FFMPEG_Writer.default_writer_config(fps).copy()
+        config["loglevel"] = "debug"
+    elif writer_type == "pyav":
+        config = PyAV_Writer.default_writer_config(fps).copy()
     config["camera_name"] = "test"
-    queue = mp.Queue()
+    if fragmented:
+        config["movflags"] = "+frag_keyframe+empty_moov"
+
+    queue = SharedFrameQueue()
     dummy_frames_proc = get_DummyFrames_process(fps, queue, n_test_frames)
-    writer = NVC_Writer(
+    writer = get_writer(
         queue,
         video_file_name=tmp_path / "test.mp4",
         metadata_file_name=tmp_path / "test.csv",
+        writer_type=writer_type,
         config=config,
     )
-    return (writer, dummy_frames_proc)
-
+    join_timeout = n_test_frames / fps + JOIN_MARGINS[writer_type]
+    return (writer, dummy_frames_proc, join_timeout)
 
-def test_NVC_writer(nvc_writer_processes, n_test_frames):
 
-    # Make sure NVC is installed, else report test not run
-    try:
-        import PyNvCodec as nvc
-    except ImportError:
-        pytest.skip("PyNvCodec not installed, skipping NVC_Writer test")
+def test_writer(writer_processes, n_test_frames):
 
     # Get the writer and dummy frames proc
-    writer, dummy_frames_proc = nvc_writer_processes
+    writer, dummy_frames_proc, join_timeout = writer_processes
 
     # Start the writer and dummy frames proc
     writer.start()
     dummy_frames_proc.start()
 
     # Wait for the processes to finish
-    dummy_frames_proc.join(timeout=60)
-    writer.join(timeout=60)
+    dummy_frames_proc.join(timeout=join_timeout)
+    writer.join(timeout=join_timeout)
 
     # Check that the video exists
     assert writer.video_file_name.exists()
     assert count_frames(str(writer.video_file_name)) == n_test_frames
 
+    # Check that every frame's metadata was written (plus the header)
+    with open(writer.metadata_file_name) as f:
+        assert len(f.readlines()) == n_test_frames + 1
+
+
+def test_assign_cpu_sets(monkeypatch, fps):
+    if not hasattr(os, "sched_getaffinity"):
+        pytest.skip("CPU affinity not supported on this platform")
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(8)))
+
+    cpu_configs = [FFMPEG_Writer.default_writer_config(fps, gpu=None) for _ in range(3)]
+    gpu_config = FFMPEG_Writer.default_writer_config(fps, gpu=0)
+    assign_cpu_sets(cpu_configs + [gpu_config])
+
+    # CPU encoders get disjoint sets of CPUs, covering all of them; GPU encoders aren't pinned
+    cpu_sets = [config["cpu_set"] for config in cpu_configs]
+    assert sorted(sum(cpu_sets, [])) == list(range(8))
+    assert gpu_config["cpu_set"] is None
 
-@pytest.fixture(scope="function")
-def ffmpeg_writer_processes(tmp_path, fps, n_test_frames):
-    """Generate linked FFMPEG_Writer and DummyFrames processes for testing"""
-    config = FFMPEG_Writer.default_writer_config(fps).copy()
+
+def test_ffmpeg_encoder_is_pinned(tmp_path, fps, monkeypatch):
+    """A CPU encoder with a cpu_set has its ffmpeg process pinned to those CPUs."""
+    calls = []
+    monkeypatch.setattr(
+        os,
+        "sched_setaffinity",
+        lambda pid, cpus: calls.append((pid, list(cpus))),
+        raising=False,
+    )
+    config = FFMPEG_Writer.default_writer_config(fps, gpu=None).copy()
     config["camera_name"] = "test"
-    config["loglevel"] = "debug"
-    queue = mp.Queue()
-    dummy_frames_proc = get_DummyFrames_process(fps, queue, n_test_frames)
+    config["cpu_set"] = [0]
     writer = FFMPEG_Writer(
-        queue,
+        mp.Queue(),
         video_file_name=tmp_path / "test.mp4",
         metadata_file_name=tmp_path / "test.csv",
         config=config,
     )
-    return (writer, dummy_frames_proc)
+    writer.logger = logging.getLogger()
 
+    writer._get_new_pipe((480, 640))
+    pid = writer.pipe.pid
+    writer.close_video()
 
-def test_ffmpeg_writer(ffmpeg_writer_processes, n_test_frames):
+    assert pid in [call_pid for call_pid, _ in calls]
+    assert all(cpus == [0] for _, cpus in calls)
 
-    # Get the writer and dummy frames proc
-    writer, dummy_frames_proc = ffmpeg_writer_processes
 
-    # Start the writer and dummy frames proc
-    writer.start()
-    dummy_frames_proc.start()
+@pytest.mark.parametrize("writer_class", [FFMPEG_Writer, PyAV_Writer])
+def test_depth_config_skips_nvenc_check(writer_class, fps, monkeypatch):
+    """Depth videos are always encoded on the CPU, so they don't check for NVENC."""
 
-    # Wait for the processes to finish
-    # NB: 5 seconds seems like a lot, but it fails at lower timeouts.
-    dummy_frames_proc.join(timeout=5)
-    writer.join(timeout=5)
+    def nvenc_available():
+        raise AssertionError("NVENC check run for a depth writer")
 
-    # Check that the video exists
-    assert writer.video_file_name.exists()
-    assert count_frames(str(writer.video_file_name)) == n_test_frames
+    monkeypatch.setattr(writer_module, "nvenc_available", nvenc_available)
+    config = writer_class.default_writer_config(fps, vid_type="depth")
+    assert config["gpu"] is None
+
+
+def test_pyav_writer_full_range(tmp_path, fps):
+    """Gray frames are stored full range (0-255) and tagged as such, like the ffmpeg writer's."""
+    import av
+    from av.video.reformatter import ColorRange
+
+    config = PyAV_Writer.default_writer_config(fps, gpu=None).copy()
+    config["camera_name"] = "test"
+    writer = PyAV_Writer(
+        mp.Queue(),
+        video_file_name=tmp_path / "test.mp4",
+        metadata_file_name=tmp_path / "test.csv",
+        config=config,
+    )
+    writer.logger = logging.getLogger()
+    writer._get_new_pipe((64, 64))
+    for _ in range(5):
+        writer.append(np.full((64, 64), 250, dtype=np.uint8))
+    writer.close_video()
+
+    with av.open(str(tmp_path / "test.mp4")) as container:
+        stream = container.streams.video[0]
+        assert stream.codec_context.color_range == ColorRange.JPEG
+        frame = next(container.decode(stream))
+        # (the luma plane, which limited range would have squeezed to at most 235)
+        luma = frame.to_ndarray()[:64]
+        assert abs(int(np.median(luma)) - 250) <= 2
+
+
+def test_ffmpeg_errors_are_logged(tmp_path, fps, caplog):
+    """If ffmpeg quits (here, because it can't create the video), its error messages are logged."""
+    config = FFMPEG_Writer.default_writer_config(fps, gpu=None).copy()
+    config["camera_name"] = "test"
+    writer = FFMPEG_Writer(
+        mp.Queue(),
+        video_file_name=tmp_path / "missing_dir" / "test.mp4",
+        metadata_file_name=tmp_path / "test.csv",
+        config=config,
+    )
+    writer.logger = logging.getLogger()
+
+    frame = np.zeros((640, 640), dtype=np.uint8)
+    writer._get_new_pipe(frame.shape)
+    with pytest.raises(BrokenPipeError):
+        for _ in range(1000):
+            writer.append(frame)
+
+    assert writer.pipe is None
+    assert "ffmpeg exited with code" in caplog.text
+    assert "Error opening output" in caplog.text
+
+
+def test_metadata_is_saved_when_writer_fails(tmp_path, fps):
+    """If the writer fails part-way through, the metadata for the frames it took is still saved."""
+    config = FFMPEG_Writer.default_writer_config(fps, gpu=None).copy()
+    config["camera_name"] = "test"
+    queue = sync_queue.Queue()
+    frame = np.zeros((640, 640), dtype=np.uint8)
+    for i in range(1000):
+        queue.put((frame, None, i * 0.033, i))
+    queue.put(tuple())
+    writer = FFMPEG_Writer(
+        queue,
+        video_file_name=tmp_path / "missing_dir" / "test.mp4",
+        metadata_file_name=tmp_path / "test.csv",
+        config=config,
+    )
+
+    # (ffmpeg can't create the video, so writing frames eventually fails)
+    with pytest.raises(BrokenPipeError):
+        writer.run()
+
+    n_frames_taken = 1000 - (queue.qsize() - 1)
+    with open(writer.metadata_file_name) as f:
+        assert len(f.readlines()) == n_frames_taken + 1
+
+
+@pytest.mark.parametrize(
+    "pixel_format, gpu, output_px_format",
+    [("yuv420p", None, "yuv420p"), ("nv12", 0, "nv12"), ("gray8", None, "yuv420p")],
+)
+def test_ffmpeg_command_output_px_format(pixel_format, gpu, output_px_format):
+    """The output pixel format is set exactly once, matching what the encoder takes natively."""
+    command = FFMPEG_Writer.create_ffmpeg_pipe_command(
+        "test.mp4", (480, 640), 30, pixel_format=pixel_format, gpu=gpu
+    )
+    output_args = command[command.index("-i") :]
+    assert output_args.count("-pix_fmt") == 1
+    assert output_args[output_args.index("-pix_fmt") + 1] == output_px_format
+
+
+def test_grey2nv12():
+    """The Y plane is the frame, and the chroma plane is neutral grey."""
+    frame = np.arange(6 * 8, dtype=np.uint16).reshape(6, 8)
+    nv12 = grey2nv12(frame)
+    assert nv12.shape == (9, 8) and nv12.dtype == np.uint8
+    assert np.array_equal(nv12[:6], frame)
+    assert (nv12[6:] == 128).all()
+
+
+@pytest.mark.parametrize("depth", [False, True])
+def test_ffmpeg_command_threads_and_input_queue(depth):
+    """Encoders use 4 threads unless told otherwise, and ffmpeg only buffers a few input frames."""
+    command = FFMPEG_Writer.create_ffmpeg_pipe_command(
+        "test.mp4", (480, 640), 30, depth=depth
+    )
+    assert command[command.index("-threads") + 1] == "4"
+    assert int(command[command.index("-thread_queue_size") + 1]) <= 16
+
+    command = FFMPEG_Writer.create_ffmpeg_pipe_command(
+        "test.mp4", (480, 640), 30, depth=depth, threads=2
+    )
+    assert command[command.index("-threads") + 1] == "2"
@@ -1,5 +1,15 @@
 import usb.core
 
+# USB vendor IDs of the products that reset_usb() knows about
+BASLER_VID = 0x2676
+MICROSOFT_VID = 0x045E
+PRODUCT_VENDOR_IDS = {
+    "a2A1920-160umBAS": BASLER_VID,
+    "Azure Kinect 4K Camera": MICROSOFT_VID,
+    "Azure Kinect Depth Camera": MICROSOFT_VID,
+    "Azure Kinect Microphone Array": MICROSOFT_VID,
+}
+
 
 def reset_usb(
     products=[
@@ -10,21 +20,38 @@ def reset_usb(
     ],
     verbose=False,
 ):
+    """Reset the USB devices whose product name is in products.
+
+    Reading a device's product name requires a control transfer to it, which is slow
+    (and can fail noisily) for unrelated devices, so devices are first filtered by
+    vendor ID using the descriptor that libusb has already cached. If any of the
+    products has no known vendor ID (see PRODUCT_VENDOR_IDS), every device is checked.
+    """
+    vendor_ids = set(PRODUCT_VENDOR_IDS.get(product) for product in products)
+    if None in vendor_ids:
+        vendor_ids = None
+
     devs = usb.core.find(find_all=True)
 
-    # Iterate over the devices and save their details if the manufacturer is 'Basler'
+    # Iterate over the devices and reset the ones that match
     for dev in devs:
+        if vendor_ids is not None and dev.idVendor not in vendor_ids:
+            continue
+
         try:
             product = dev.product
-            serial_number = dev.serial_number  # Get the serial number
         except Exception as e:
             if verbose:
-                print(f"Error retrieving product info or serial number: {e}")
+                print(f"Error retrieving product info: {e}")
             continue
 
         if product in products:
             try:
                 if verbose:
+                    try:
+                        serial_number = dev.serial_number
+                    except Exception:
+                        serial_number = "unknown"
                     print(
                         f"resetting {product} ({hex(dev.idVendor)}, {hex(dev.idProduct)}) with Serial Number: {serial_number}"
                     )
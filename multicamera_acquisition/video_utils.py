@@ -1,13 +1,160 @@
+import collections
 import datetime
+import os
+import struct
 import subprocess
+import threading
 
 import av
 import numpy as np
 
+from multicamera_acquisition.subprocess_utils import drain_lines
+
+
+# Frame counts by (file name, size, modification time), so that unchanged videos aren't re-opened
+_FRAME_COUNT_CACHE = {}
+
 
 def count_frames(file_name):
-    with av.open(file_name, "r") as reader:
-        return reader.streams.video[0].frames
+    stat = os.stat(file_name)
+    key = (str(file_name), stat.st_size, stat.st_mtime_ns)
+    if key not in _FRAME_COUNT_CACHE:
+        n_frames = None
+        if str(file_name).endswith(".mp4"):
+            n_frames = count_frames_mp4(file_name)
+        if n_frames is None:
+            with av.open(file_name, "r") as reader:
+                stream = reader.streams.video[0]
+                n_frames = stream.frames
+                if n_frames == 0:
+                    # The container doesn't record the number of frames (e.g. mkv or nut),
+                    # so count the video packets, which is like ffprobe -count_packets
+                    # (demuxing, but not decoding, the whole file)
+                    n_frames = sum(
+                        1 for packet in reader.demux(stream) if packet.size > 0
+                    )
+        _FRAME_COUNT_CACHE[key] = n_frames
+    return _FRAME_COUNT_CACHE[key]
+
+
+def _iter_boxes(data, start=0, end=None):
+    """Yield (box type, payload start, payload end) for the MP4 boxes in data[start:end]."""
+    end = len(data) if end is None else end
+    while start + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, start)
+        header = 8
+        if size == 1:
+            (size,) = struct.unpack_from(">Q", data, start + 8)
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield box_type, start + header, min(start + size, end)
+        start += size
+
+
+def _find_box(data, box_type, start=0, end=None):
+    for found_type, payload_start, payload_end in _iter_boxes(data, start, end):
+        if found_type == box_type:
+            return payload_start, payload_end
+    return None
+
+
+def _read_top_level_boxes(file_name, box_types):
+    """Read the payloads of the given top-level boxes of an MP4 file, skipping over the
+    (much larger) media data. Returns a list of (box type, payload) tuples.
+    """
+    boxes = []
+    with open(file_name, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        offset = 0
+        while offset + 8 <= file_size:
+            f.seek(offset)
+            header = f.read(16)
+            size, box_type = struct.unpack_from(">I4s", header)
+            header_size = 8
+            if size == 1:
+                (size,) = struct.unpack_from(">Q", header, 8)
+                header_size = 16
+            elif size == 0:
+                size = file_size - offset
+            if size < header_size:
+                break
+            if box_type in box_types:
+                f.seek(offset + header_size)
+                boxes.append((box_type, f.read(size - header_size)))
+            offset += size
+    return boxes
+
+
+def count_frames_mp4(file_name):
+    """Count the frames in an MP4 file by reading the video track's sample tables.
+
+    This reads a few KB of metadata rather than opening the file with a demuxer.
+    For fragmented MP4s, the samples in each fragment's track run (trun) boxes are added up.
+    Returns None if the count can't be read this way, in which case count_frames()
+    falls back to PyAV.
+    """
+    try:
+        boxes = _read_top_level_boxes(file_name, (b"moov", b"moof"))
+    except (OSError, struct.error):
+        return None
+    moov = [payload for box_type, payload in boxes if box_type == b"moov"]
+    if len(moov) != 1:
+        return None
+    moov = moov[0]
+
+    # Find the video track
+    for box_type, trak_start, trak_end in _iter_boxes(moov):
+        if box_type != b"trak":
+            continue
+        mdia = _find_box(moov, b"mdia", trak_start, trak_end)
+        if mdia is None:
+            continue
+
+        # hdlr payload: version / flags (4), pre-defined (4), handler type (4)
+        hdlr = _find_box(moov, b"hdlr", *mdia)
+        if hdlr is not None and moov[hdlr[0] + 8 : hdlr[0] + 12] == b"vide":
+            break
+    else:
+        return None
+
+    # tkhd payload: version (1), flags (3), creation / modification times (4 or 8 each), track ID (4)
+    tkhd = _find_box(moov, b"tkhd", trak_start, trak_end)
+    if tkhd is None:
+        return None
+    time_size = 8 if moov[tkhd[0]] == 1 else 4
+    (track_id,) = struct.unpack_from(">I", moov, tkhd[0] + 4 + 2 * time_size)
+
+    # Samples listed up front, in the stsz / stz2 box
+    # (payload: version / flags (4), sample size (4), sample count (4))
+    n_frames = 0
+    box = mdia
+    for child in [b"minf", b"stbl"]:
+        box = _find_box(moov, child, *box)
+        if box is None:
+            return None
+    stsz = _find_box(moov, b"stsz", *box) or _find_box(moov, b"stz2", *box)
+    if stsz is not None:
+        (n_frames,) = struct.unpack_from(">I", moov, stsz[0] + 8)
+
+    # Samples in movie fragments, in each track fragment's trun boxes
+    # (tfhd payload: version / flags (4), track ID (4); trun payload: version / flags (4), sample count (4))
+    for box_type, moof in boxes:
+        if box_type != b"moof":
+            continue
+        for traf_type, traf_start, traf_end in _iter_boxes(moof):
+            if traf_type != b"traf":
+                continue
+            tfhd = _find_box(moof, b"tfhd", traf_start, traf_end)
+            if tfhd is None or struct.unpack_from(">I", moof, tfhd[0] + 4)[0] != track_id:
+                continue
+            for trun_type, trun_start, _ in _iter_boxes(moof, traf_start, traf_end):
+                if trun_type == b"trun":
+                    n_frames += struct.unpack_from(">I", moof, trun_start + 4)[0]
+
+    return n_frames
 
 
 def read_frames(
@@ -15,11 +162,12 @@ def read_frames(
     frames,
     threads=6,
     fps=30,
-    pixel_format="gray8",
+    pixel_format="gray16",
     frame_size=(640, 576),
     slices=24,
     slicecrc=1,
     get_cmd=False,
+    gpu=None,
 ):
     """Reads in frames from the .mp4/.avi file using a pipe from ffmpeg.
     Args:
@@ -27,24 +175,49 @@ def read_frames(
         frames (list or 1d numpy array): list of frames to grab
         threads (int): number of threads to use for decode
         fps (int): frame rate of camera in Hz
-        pixel_format (str): ffmpeg pixel format of data
+        pixel_format (str): ffmpeg pixel format to read the frames as (gray16 frames
+            are returned as uint16, others as uint8)
         frame_size (str): wxh frame size in pixels
         slices (int): number of slices to use for decode
         slicecrc (int): check integrity of slices
+        gpu (int): if not None, decode on this GPU with NVDEC (for h264 / hevc videos;
+            lossless ffv1 depth videos must be decoded on the CPU). Each reader
+            creates its own CUDA context, so prefer a few large reads over many
+            small concurrent ones.
     Returns:
         3d numpy array:  frames x h x w
     """
 
+    # Seeking before the input is both fast and exact: ffmpeg jumps to the last keyframe
+    # before the first frame (directly to it, for intra-only codecs like ffv1), then
+    # decodes and drops the frames in between
     command = [
         "ffmpeg",
         "-loglevel",
         "fatal",
         "-ss",
         str(datetime.timedelta(seconds=frames[0] / fps)),
+    ]
+    if gpu is not None:
+        # Decode on the GPU, keeping frames in GPU memory until they're downloaded below
+        command += [
+            "-hwaccel",
+            "cuda",
+            "-hwaccel_device",
+            str(gpu),
+            "-hwaccel_output_format",
+            "cuda",
+        ]
+    command += [
         "-i",
         filename,
         "-vframes",
         str(len(frames)),
+    ]
+    if gpu is not None:
+        # Copy decoded frames back to the host (NVDEC outputs nv12), then convert to pixel_format
+        command += ["-vf", "hwdownload,format=nv12"]
+    command += [
         "-f",
         "image2pipe",
         "-s",
@@ -57,8 +230,6 @@ def read_frames(
         str(slices),
         "-slicecrc",
         str(slicecrc),
-        "-pix_fmt",
-        "gray16",
         "-vcodec",
         "rawvideo",
         "-",
@@ -67,12 +238,34 @@ def read_frames(
     if get_cmd:
         return command
 
-    pipe = subprocess.Popen(command, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    out, err = pipe.communicate()
-    if err:
-        print("error", err)
-        return None
-    video = np.frombuffer(out, dtype="uint16").reshape(
-        (len(frames), frame_size[1], frame_size[0])
+    # Stream the decoded frames straight into the output array,
+    # rather than collecting all of ffmpeg's output in memory first
+    dtype = np.uint16 if pixel_format.startswith("gray16") else np.uint8
+    video = np.empty((len(frames), frame_size[1], frame_size[0]), dtype=dtype)
+    buffer = memoryview(video).cast("B")
+    pipe = subprocess.Popen(
+        command, stderr=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0
+    )
+
+    # Read stderr alongside stdout, so that ffmpeg can't block on a full stderr pipe
+    errors = collections.deque(maxlen=100)
+    stderr_thread = threading.Thread(
+        target=drain_lines, args=(pipe.stderr, errors), daemon=True
     )
-    return video
+    stderr_thread.start()
+
+    n_bytes = 0
+    while n_bytes < len(buffer):
+        n_read = pipe.stdout.readinto(buffer[n_bytes:])
+        if not n_read:
+            break
+        n_bytes += n_read
+    pipe.stdout.close()
+    pipe.wait()
+    stderr_thread.join()
+    if errors:
+        print("error", "\n".join(errors))
+        return None
+
+    # Only return complete frames if the video ended early
+    return video[: n_bytes // video[0].nbytes]
@@ -1,10 +1,12 @@
+import functools
 import glob
+import importlib.util
 import logging
 import multiprocessing as mp
 import os
 import queue as sync_queue
-import time
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import matplotlib.pyplot as plt
@@ -15,6 +17,22 @@ from PIL import ImageTk
 
 from multicamera_acquisition.logging_utils import setup_child_logger
 
+# pandas can parse CSVs with pyarrow's multithreaded reader when it's installed,
+# which is much faster for long metadata files. (Older pandas versions only had
+# partial, experimental support for it, so they keep the default C parser.)
+_CSV_ENGINE = (
+    "pyarrow"
+    if importlib.util.find_spec("pyarrow") and int(pd.__version__.split(".")[0]) >= 2
+    else "c"
+)
+
+# The metadata columns that plot_video_stats() plots
+_PLOTTED_COLUMNS = ["frame_id", "frame_timestamp", "frame_image_uid", "queue_size"]
+
+# The most frames the display skips per camera per update when catching up, so that
+# a camera that outpaces the display can't keep it from redrawing
+_MAX_FRAMES_SKIPPED = 8
+
 
 class MultiDisplay(mp.Process):
     def __init__(
@@ -25,6 +43,7 @@ class MultiDisplay(mp.Process):
         config=None,
         logger_queue=None,
         logging_level=logging.DEBUG,
+        display_ready=None,
     ):
         super().__init__()
 
@@ -37,6 +56,10 @@ class MultiDisplay(mp.Process):
         self.display_ranges = display_ranges
         self.num_cameras = len(camera_list)
 
+        # If given, an mp.Event that producers set after sending frames, so that
+        # the display can sleep until there's a frame instead of polling each queue
+        self.display_ready = display_ready
+
         # Set up the config
         if config is None:
             self.config = self.default_MultiDisplay_config().copy()
@@ -80,18 +103,23 @@ class MultiDisplay(mp.Process):
 
         return root, labels
 
-    def _fetch_image(self, queue, camera_name, log_if_error):
+    def _fetch_image(self, queue, camera_name, log_if_error, block=True):
         try:
-            # Note: earlier code used queue.qsize() > 1; have not yet verified
-            # that queue.empty performs the same
-            if not queue.empty():
-                while not queue.empty():
-                    img = get_latest(queue, timeout=0.01)  # empties the queue in case we've fallen behind?
-            else:
+            if block:
                 img = queue.get(timeout=0.01)
-        except Exception as error:
+            else:
+                img = queue.get_nowait()
+
+            # Skip ahead to the latest item, in case we've fallen behind.
+            # (Each get() hands the previous frame's slot back to the producer, so stop at
+            # the last item rather than calling get_nowait() until it fails.)
+            for _ in range(_MAX_FRAMES_SKIPPED):
+                if len(img) == 0 or queue.empty():
+                    break
+                img = queue.get_nowait()
+        except sync_queue.Empty as error:
             if log_if_error:
-                logging.info("{}: Timeout occurred {}".format(camera_name, str(error)))
+                logging.debug("{}: Timeout occurred {}".format(camera_name, str(error)))
             return [None]
         return img
 
@@ -112,22 +140,46 @@ class MultiDisplay(mp.Process):
 
         root, labels = self._init_layout()
 
-        quit = False
-        while True:
-            # initialized checks to see if recording has started
-            initialized = np.zeros(len(self.queues)).astype(bool)
+        # Each camera's Tk image, created from its first frame (so that it has the
+        # frames' mode and size) and then updated in place with paste()
+        photos = [None] * len(self.queues)
+
+        # Keep going until every camera has finished, so that none of them
+        # are left waiting for their last frames to be consumed
+        finished = [False] * len(self.queues)
+
+        # initialized checks to see if recording has started
+        initialized = [False] * len(self.queues)
+
+        # With display_ready, the queues are only checked once a frame may be
+        # waiting, so an empty queue is expected and not worth logging
+        block = self.display_ready is None
+        while not all(finished):
+            if self.display_ready is not None:
+                # Sleep until a camera sends a frame (but keep the window responsive).
+                # The event is cleared before the queues are checked, so that a
+                # frame sent in the meantime sets it again rather than being missed.
+                self.display_ready.wait(timeout=0.05)
+                self.display_ready.clear()
+
             for qi, (queue, camera_name) in enumerate(
                 zip(self.queues, self.camera_list)
             ):
+                if finished[qi]:
+                    continue
+
                 data = self._fetch_image(
-                    queue, camera_name, log_if_error=initialized[qi]
+                    queue,
+                    camera_name,
+                    log_if_error=initialized[qi] and block,
+                    block=block,
                 )
 
                 # If acq sends an empty tuple, it means it's done
                 if len(data) == 0:
-                    quit = True
-                    self.logger.debug("No data, quitting...")
-                    break
+                    finished[qi] = True
+                    self.logger.debug(f"No data from {camera_name}")
+                    continue
 
                 # retrieve frame
                 img = data[0]
@@ -141,16 +193,16 @@ class MultiDisplay(mp.Process):
                     )
 
                     # update label with new image
-                    img = ImageTk.PhotoImage(frame)
-                    labels[qi].config(image=img)
-                    labels[qi].image = img
+                    if photos[qi] is None:
+                        photos[qi] = ImageTk.PhotoImage(frame.mode, frame.size)
+                        labels[qi].config(image=photos[qi])
+                    photos[qi].paste(frame)
                 else:
                     continue
 
-            if quit:
-                break
             # update tkinter window
             root.update()
+        self.logger.debug("No data, quitting...")
         root.destroy()
 
         # Here, we empty the queues to make sure we don't leave any data in them.
@@ -178,65 +230,127 @@ class MultiDisplay(mp.Process):
         # return config.validate_against_schema(self.config, self.get_config_schema())
 
 
-def get_latest(queue, timeout=0.1):
-    start_time = time.time()
-    try:
-        item = queue.get(timeout=timeout)
-        while True:
-            try:
-                elapsed_time = time.time() - start_time
-                remaining_time = timeout - elapsed_time
-
-                if remaining_time > 0:
-                    next_item = queue.get(timeout=remaining_time)
-                    item = next_item
-                else:
-                    break
-            except sync_queue.Empty:
-                break
-    except sync_queue.Empty:
-        item = None
-
-    return item
-
-
 def format_frame(frame, display_size, display_range, is_depth):
-    frame = cv2.resize(frame, display_size)
+    # This is only a preview, so nearest-neighbour resizing is good enough,
+    # except when shrinking by 2x or more, where it would alias badly
+    if frame.shape[1] >= 2 * display_size[0] and frame.shape[0] >= 2 * display_size[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_NEAREST
 
     # normalize in range
+    # (Both paths below use the same float range. As floats, (0, 255) and
+    # (0.0, 255.0) also share a cached lookup table.)
+    if display_range is not None:
+        min_value, max_value = float(display_range[0]), float(display_range[1])
+    if display_range is not None and frame.dtype in (np.uint8, np.uint16):
+        # Clip, scale and cast to uint8 (and for depth, apply the colormap)
+        # in a single pass, by table lookup
+        lut = display_lut(
+            min_value,
+            max_value,
+            np.iinfo(frame.dtype).max + 1,
+            colormap=cv2.COLORMAP_TURBO if is_depth else None,
+        )
+        # Nearest-neighbour resizing only picks pixels, so it gives the same
+        # result before or after the lookup. When it enlarges the frame, look
+        # up the (fewer) original pixels first, and resize them as uint8.
+        lookup_first = (
+            interpolation == cv2.INTER_NEAREST
+            and frame.shape[0] * frame.shape[1] < display_size[0] * display_size[1]
+        )
+        if not lookup_first:
+            frame = cv2.resize(frame, display_size, interpolation=interpolation)
+        if is_depth:
+            frame = np.take(lut, frame, axis=0)
+        elif frame.dtype == np.uint8:
+            frame = cv2.LUT(frame, lut)
+        else:
+            # (np.take is about twice as fast as lut[frame] for this)
+            frame = np.take(lut, frame)
+        if lookup_first:
+            frame = cv2.resize(frame, display_size, interpolation=interpolation)
+        return PIL.Image.fromarray(frame)
+
+    frame = cv2.resize(frame, display_size, interpolation=interpolation)
     if display_range is not None:
         frame = normalize_array(
             frame,
-            min_value=display_range[0],
-            max_value=display_range[1],
-        ).astype(np.uint8)
+            min_value=min_value,
+            max_value=max_value,
+        )
     else:
-        frame = normalize_array(frame).astype(np.uint8)
+        frame = normalize_array(frame)
 
     # int16 should be azure data
     if is_depth:
-        # Convert frame to turbo/jet colormap
+        # Convert frame to turbo/jet colormap (OpenCV gives BGR, PIL expects RGB)
         frame = cv2.applyColorMap(frame, cv2.COLORMAP_TURBO)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
 
     return PIL.Image.fromarray(frame)
 
 
+@functools.lru_cache(maxsize=None)
+def display_lut(min_value, max_value, n_values, colormap=None):
+    """A lookup table mapping each of n_values pixel values to the uint8 value
+    that normalize_array() gives it, for the range (min_value, max_value).
+
+    If colormap (an OpenCV colormap) is given, the table instead has shape
+    (n_values, 3), mapping each value to the RGB color that cv2.applyColorMap()
+    gives its normalized value.
+    """
+    lut = normalize_array(np.arange(n_values, dtype=np.float64), min_value, max_value)
+    if colormap is not None:
+        lut = cv2.applyColorMap(lut.reshape(-1, 1), colormap)
+        lut = cv2.cvtColor(lut, cv2.COLOR_BGR2RGB).reshape(-1, 3)
+    return lut
+
+
+# Array dtypes that OpenCV can process directly
+_CV2_DTYPES = (np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float32, np.float64)
+
+
 def normalize_array(frame, min_value=None, max_value=None):
-    if min_value is None:
-        min_value = np.min(frame)
-        max_value = np.max(frame)
-    frame[frame > max_value] = max_value
-    frame[frame < min_value] = min_value
-    # frame = np.clip(frame, min_value, max_value)  # Ensure values are in the range [min_value, max_value]
-    frame = (
-        (frame - min_value) / (max_value - min_value)
-    ) * 255.0  # Normalize to [0, 255]
-    return frame.astype(np.uint8)
+    """Scale frame from (min_value, max_value) to uint8 (0-255), clipping values
+    outside the range. If no range is given, the frame's own min and max are used.
+
+    The scaling, rounding and cast to uint8 are done in one pass by
+    cv2.convertScaleAbs, which also saturates values above max_value.
+    Values below min_value are clipped first (since convertScaleAbs would
+    take their absolute value). The input frame is not modified.
+    """
+    if frame.dtype not in _CV2_DTYPES:
+        frame = frame.astype(np.float64)
+    # (cv2.minMaxLoc only takes single-channel 2D arrays, and cv2.max with a
+    # scalar only clips the first channel, so other frames are clipped by numpy)
+    if frame.ndim != 2:
+        if min_value is None:
+            min_value, max_value = float(np.min(frame)), float(np.max(frame))
+        else:
+            frame = np.maximum(frame, min_value)
+    elif min_value is None:
+        min_value, max_value, _, _ = cv2.minMaxLoc(frame)
+    else:
+        frame = cv2.max(frame, min_value)
+    if max_value > min_value:
+        scale = 255.0 / (max_value - min_value)
+    else:
+        scale = 0.0
+    return cv2.convertScaleAbs(frame, alpha=scale, beta=-min_value * scale)
 
 
 def plot_video_stats(csv_path, name):
-    # Load the data
-    df = pd.read_csv(csv_path)
+    # Load the data (only the columns that are plotted, of those the file has)
+    header = pd.read_csv(csv_path, nrows=0).columns
+    df = pd.read_csv(
+        csv_path,
+        engine=_CSV_ENGINE,
+        usecols=[column for column in _PLOTTED_COLUMNS if column in header],
+    )
+    timestamps = df.frame_timestamp.to_numpy()
+    diffs = np.diff(timestamps)
+    uid_diffs = np.diff(df.frame_image_uid.to_numpy())
 
     # Set up plot
     fig, axs = plt.subplots(
@@ -249,28 +363,24 @@ def plot_video_stats(csv_path, name):
 
     # Plot frame diffs (ie, check for dropped frames)
     axs[0].set_title(f"{name}: frame diff (dropped frames?)")
-    axs[0].plot(np.diff(df.frame_id.values))
+    axs[0].plot(np.diff(df.frame_id.to_numpy()))
 
     # Plot camera timestamp diffs
-    diffs = np.diff(df.frame_timestamp.values)
     axs[1].set_title(f"{name}: camera timestamp diff")
     axs[1].plot(diffs / np.median(diffs))
 
     # Plot computer timestamp diffs
     axs[2].set_title(f"{name}: computer timestamp (uid) diff")
-    axs[2].plot(
-        np.diff(df.frame_image_uid.values)
-        / np.median(np.diff(df.frame_image_uid.values))
-    )
+    axs[2].plot(uid_diffs / np.median(uid_diffs))
 
     # Plot queue size
     axs[3].set_title(f"{name}: queue size")
-    axs[3].plot(df.queue_size.values)
+    axs[3].plot(df.queue_size.to_numpy())
     axs[3].set_xlabel("Frames")
     axs[3].set_title("Queue size")
 
     # Plot relative occurrence of framerates
-    axs[4].hist(1 / (np.diff(df.frame_timestamp.values) * 1e-9), bins=100)
+    axs[4].hist(1 / (diffs * 1e-9), bins=100)
     axs[4].set_xlabel("Framerate")
     axs[4].set_ylabel("Count")
     axs[4].set_title(f"{name}: framerate histogram")
@@ -280,7 +390,7 @@ def plot_video_stats(csv_path, name):
     plt.show()
 
     # Print some info
-    time_elapsed = (df.frame_timestamp.values[-1] - df.frame_timestamp.values[0]) * 1e-9
+    time_elapsed = (timestamps[-1] - timestamps[0]) * 1e-9
     avg_diffs = np.mean(diffs)
     print(f"Total time elapsed: {time_elapsed} seconds")
     print(f"Average framerate: {1 / (avg_diffs* 1e-9)} Hz")
@@ -349,13 +459,28 @@ def load_first_frames(location):
     files = list(glob.glob(str(location / "*.mp4")))
     if len(files) == 0:
         logging.log(logging.WARN, f"No recordings found at {location}")
-    for f in files:
-        basename = os.path.basename(f)
-        cam_name = basename.split(".")[-3]
-        cap = cv2.VideoCapture(f)
-        if cap.isOpened():
-            _, frame = cap.read()
-            images[cam_name] = frame
-        else:
-            logging.log(logging.WARN, f"Could not read video {f}.")
+        return images
+
+    # Open and decode the videos in parallel (OpenCV releases the GIL while it works)
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        results = executor.map(_read_first_frame, files)
+        for f, (opened, frame) in zip(files, results):
+            basename = os.path.basename(f)
+            cam_name = basename.split(".")[-3]
+            if opened:
+                images[cam_name] = frame
+            else:
+                logging.log(logging.WARN, f"Could not read video {f}.")
     return images
+
+
+def _read_first_frame(file_name):
+    """Read the first frame of a video. Returns (whether it opened, the frame)."""
+    cap = cv2.VideoCapture(file_name)
+    try:
+        if not cap.isOpened():
+            return False, None
+        _, frame = cap.read()
+        return True, frame
+    finally:
+        cap.release()
@@ -1,8 +1,12 @@
+import collections
 import csv
+import functools
 import logging
 import multiprocessing as mp
 import os
 import subprocess
+import sys
+import threading
 import time
 import traceback
 import warnings
@@ -11,6 +15,7 @@ from pathlib import Path
 import numpy as np
 
 from multicamera_acquisition.logging_utils import setup_child_logger
+from multicamera_acquisition.subprocess_utils import drain_lines
 
 
 class BaseWriter(mp.Process):
@@ -100,7 +105,10 @@ class BaseWriter(mp.Process):
                     "line_status",
                 ]
             )
-        self.metadata_file = open(self.metadata_file_name, "a", newline="")
+        # (Rows are small, so buffer them into larger writes)
+        self.metadata_file = open(
+            self.metadata_file_name, "a", newline="", buffering=1 << 16
+        )
         self.metadata_writer = csv.writer(self.metadata_file)
 
     def _get_new_pipe(self, data_shape):
@@ -141,7 +149,8 @@ class BaseWriter(mp.Process):
                 img, line_status, camera_timestamp, self.frames_received = data
 
                 # Get the metadata about the frame
-                frame_image_uid = str(round(time.time(), 5)).zfill(5)
+                # (formatting to 5 decimals rounds, as round() did, in one step)
+                frame_image_uid = f"{time.time():.5f}"
                 try:
                     qsize = self.queue.qsize()
                 except NotImplementedError:
@@ -192,8 +201,13 @@ class BaseWriter(mp.Process):
             self.logger.error(traceback.format_exc())
             raise e
 
-        self.logger.debug(f"Closing writer pipe ({self.config['camera_name']})")
-        self.close_video()
+        finally:
+            # Close the metadata file, flushing any buffered rows, even if the writer
+            # failed (the process exits without flushing files that are still open)
+            self.metadata_file.close()
+
+            self.logger.debug(f"Closing writer pipe ({self.config['camera_name']})")
+            self.close_video()
 
         self.logger.debug(f"Writer run finished ({self.config['camera_name']})")
         self.finish()
@@ -332,15 +346,15 @@ class NVC_Writer(BaseWriter):
             gpu_id=self.config["gpu"],
             format=nvc.PixelFormat.NV12,
         )
-        self.encFile = open(self.video_file_name, "wb")
+        # (Encoded packets are often only a few KB, so buffer them into larger writes)
+        self.encFile = open(self.video_file_name, "wb", buffering=1 << 20)
         self._current_vid_muxing = False
         self.logger.debug("Pipe created")
 
     def append(self, data):
-        # Cast to uint8
-        data = data.astype(np.uint8)
-
-        # Convert to nv12, which is dims X by Y*1.5
+        # Convert to nv12, which is dims X by Y*1.5.
+        # The frame is cast to uint8 as it's copied into the Y plane,
+        # so there's no separate astype() copy per frame.
         if self.nv12_placeholder is None:
             nv12_array = grey2nv12(data)
             self.img_dims = data.shape
@@ -356,8 +370,8 @@ class NVC_Writer(BaseWriter):
             self.logger.debug(f"failed to create frame: {e}")
 
         if success:
-            encByteArray = bytearray(self.encFrame)
-            self.encFile.write(encByteArray)
+            # (ndarrays support the buffer protocol, so the packet is written without a copy)
+            self.encFile.write(self.encFrame)
 
     def close_video(self):
         # Flush the PyNvCodec encoder
@@ -381,8 +395,7 @@ class NVC_Writer(BaseWriter):
         while True:
             success = self.pipe.FlushSinglePacket(self.encFrame)
             if success:
-                encByteArray = bytearray(self.encFrame)
-                self.encFile.write(encByteArray)
+                self.encFile.write(self.encFrame)
                 self.frames_flushed += 1
             else:
                 break
@@ -514,7 +527,12 @@ class FFMPEG_Writer(BaseWriter):
         )
 
         # FFMPEG-specific stuff
-        pass
+        # Constant chroma planes, when sending gray frames as yuv420p / nv12
+        self.chroma = None
+
+        # The last lines ffmpeg wrote to stderr, and the thread that reads them
+        self.ffmpeg_log = collections.deque(maxlen=100)
+        self._stderr_thread = None
 
         # Read in the config
         self.validate_config()
@@ -524,53 +542,167 @@ class FFMPEG_Writer(BaseWriter):
         assert "pixel_format" in self.config, "pixel_format msut be specified"
 
     def append(self, data):
-        # Convert to the correct data format
-        if self.config["pixel_format"] == "gray8":
-            data = data.astype(np.uint8)
-        elif self.config["pixel_format"] == "gray16":
-            data = data.astype(np.uint16)
+        try:
+            self._write_frame(data)
+        except BrokenPipeError:
+            # ffmpeg has quit; its error messages say why
+            self.close_video()
+            raise
+
+    def _make_frame_writer(self):
+        """Make a function that writes one frame to the current pipe.
+
+        The pixel format and pipe are looked up once here, rather than on every frame.
+        """
+        stdin = self.pipe.stdin
+        dtype = {"gray8": np.uint8, "gray16": np.uint16}.get(
+            self.config["pixel_format"]
+        )
+
+        # Frames are converted to the right data format (a no-op if they're already contiguous
+        # and the right dtype), then written to the pipe straight from the array's buffer,
+        # without copying to bytes.
+        if self.chroma is None:
+
+            def write_frame(data):
+                stdin.write(memoryview(np.ascontiguousarray(data, dtype=dtype)))
 
-        # Write it to the pipe
-        self.pipe.stdin.write(data.tobytes())
+        elif dtype is np.uint16:
+            # 16-bit frames sent as 8-bit nv12 (see _get_new_pipe): keep the high byte of
+            # each pixel, which is a single strided copy of the little-endian frame
+            chroma = memoryview(self.chroma)
+
+            def write_frame(data):
+                data = np.ascontiguousarray(data, dtype="<u2").view(np.uint8)[..., 1::2]
+                write_buffers(stdin, [memoryview(np.ascontiguousarray(data)), chroma])
+
+        else:
+            # Write the chroma planes along with the frame, in the same system call
+            chroma = memoryview(self.chroma)
+
+            def write_frame(data):
+                data = memoryview(np.ascontiguousarray(data, dtype=dtype))
+                write_buffers(stdin, [data, chroma])
+
+        return write_frame
 
     def _get_new_pipe(self, data_shape):
+        # A gray frame is the Y plane of a yuv420p frame whose U and V planes are all 128.
+        # Sending frames in the output format saves ffmpeg converting each one.
+        # (With all-128 chroma, the interleaved UV plane of an nv12 frame -- NVENC's native
+        # format -- is byte-for-byte the same as yuv420p's U and V planes.)
+        # NVENC only encodes 8-bit frames, so gray16 frames bound for it are reduced to their
+        # high byte by the writer (see _make_frame_writer), rather than by ffmpeg's swscale.
+        pixel_format = self.config["pixel_format"]
+        if (
+            (
+                pixel_format == "gray8"
+                or (pixel_format == "gray16" and self.config["gpu"] is not None)
+            )
+            and not self.config["depth"]
+            and self.config.get("output_px_format", "yuv420p") == "yuv420p"
+            and data_shape[0] % 2 == 0
+            and data_shape[1] % 2 == 0
+        ):
+            pixel_format = "nv12" if self.config["gpu"] is not None else "yuv420p"
+            self.chroma = np.full(
+                (data_shape[0] // 2, data_shape[1]), 128, dtype=np.uint8
+            )
+        else:
+            self.chroma = None
+
+        # Pin CPU encoders to their own cores, if assigned (see assign_cpu_sets())
+        cpu_set = self.config.get("cpu_set")
+        if self.config["gpu"] is not None or not hasattr(os, "sched_setaffinity"):
+            cpu_set = None
+
         # Generate the ffmpeg command
         command = FFMPEG_Writer.create_ffmpeg_pipe_command(
             self.video_file_name,
             data_shape,
             self.config["fps"],
             quality=self.config["quality"],
-            pixel_format=self.config["pixel_format"],
+            pixel_format=pixel_format,
             gpu=self.config["gpu"],
             depth=self.config["depth"],
             loglevel=self.config["loglevel"],
+            movflags=self.config.get("movflags"),
+            threads=len(cpu_set) if cpu_set else None,
         )
 
-        # Create a subprocess pipe to write frames
-        # TODO: give user option to save ffmpeg logs to an output file.
-        # Having trouble getting them to write directly to the mp logger.
+        # Create a subprocess pipe to write frames.
+        # ffmpeg's stderr is read on a separate thread (so that it can never fill up and
+        # stall ffmpeg), and only the last few lines are kept, to be logged if it fails.
         self.pipe = subprocess.Popen(
             command,
             stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if cpu_set:
+            # (pinned from here, rather than with preexec_fn, which isn't safe
+            # in a process with threads, like this one)
+            pin_process(self.pipe.pid, cpu_set)
+        self.ffmpeg_log.clear()
+        self._stderr_thread = threading.Thread(
+            target=drain_lines, args=(self.pipe.stderr, self.ffmpeg_log), daemon=True
+        )
+        self._stderr_thread.start()
+
+        # Let the pipe hold (at least) a whole frame, so writes don't stall part-way through
+        frame_bytes = int(np.prod(data_shape)) * (
+            2 if self.config["pixel_format"] == "gray16" else 1
         )
+        if self.chroma is not None:
+            frame_bytes += self.chroma.nbytes
+        enlarge_pipe_buffer(self.pipe.stdin, max(frame_bytes, 1 << 20))
+
+        self._write_frame = self._make_frame_writer()
 
     def close_video(self):
         if self.pipe is not None:
-            self.pipe.stdin.close()
+            try:
+                self.pipe.stdin.close()
+            except BrokenPipeError:
+                pass
+
+            # Wait for ffmpeg to finish the video, so it's complete once the writer is done
+            self.pipe.wait()
+            self._stderr_thread.join()
+            if self.pipe.returncode != 0:
+                self.logger.error(
+                    f"ffmpeg exited with code {self.pipe.returncode} while writing "
+                    f"{self.video_file_name}:\n" + "\n".join(self.ffmpeg_log)
+                )
         self.pipe = None
 
     @staticmethod
-    def default_writer_config(fps, vid_type="ir", gpu=None):
+    def default_writer_config(fps, vid_type="ir", gpu="auto"):
         """A default config dict for an ffmpeg writer.
 
         Frame size tbd on the fly.
+
+        If gpu is "auto", ir videos are encoded on GPU 0 with NVENC when it's
+        available, and on the CPU otherwise. Pass gpu=None to force CPU encoding.
         """
+        # (only ir videos can use the GPU, so only they need the NVENC check)
+        if gpu == "auto" and vid_type == "ir":
+            gpu = 0 if nvenc_available() else None
+
         config = {
             "fps": fps,
             "max_video_frames": None,  # None means no limit; otherwise, pass an int
             "quality": 15,
             "loglevel": "error",
             "type": "ffmpeg",
+            # MP4 muxer flags. E.g. "+frag_keyframe+empty_moov" writes a fragmented MP4,
+            # which is readable up to the last keyframe even if the recording crashes,
+            # and needs no index written at the end. (But note that some readers,
+            # like PyAV's stream.frames, can't count the frames in fragmented MP4s.)
+            "movflags": None,
+            # CPUs to run the encoder on (when encoding on the CPU). None means any CPU,
+            # unless the writer is given its own set by assign_cpu_sets().
+            "cpu_set": None,
         }
 
         if vid_type == "ir":
@@ -611,8 +743,13 @@ class FFMPEG_Writer(BaseWriter):
         gpu=None,
         depth=False,
         loglevel="error",
+        movflags=None,
+        threads=None,
     ):
         """Create a pipe for ffmpeg"""
+        if threads is None:
+            threads = 4
+
         # Get the size of the frame
         frame_size = "{0:d}x{1:d}".format(frame_shape[1], frame_shape[0])
         if not depth:
@@ -627,11 +764,22 @@ class FFMPEG_Writer(BaseWriter):
                 "-vcodec",
                 "rawvideo",
                 "-pix_fmt",
-                pixel_format,  # Input pixel format (gray8, gray16, etc.)
+                pixel_format,  # Input pixel format (gray8, gray16, yuv420p, etc.)
                 "-s",
                 frame_size,  # Input frame size
                 "-r",
                 str(fps),  # Input frames per second
+                # Number of input frames to buffer. Kept small, so that a slow encoder
+                # applies backpressure to the writer instead of piling up raw frames in RAM.
+                "-thread_queue_size",
+                "16",
+            ]
+
+            if pixel_format in ["yuv420p", "nv12"]:
+                # Gray frames sent as yuv420p / nv12 are full range (0-255), not tv range (16-235)
+                command += ["-color_range", "pc"]
+
+            command += [
                 "-i",
                 "-",  # Read input from stdin
                 "-an",  # No audio
@@ -643,11 +791,24 @@ class FFMPEG_Writer(BaseWriter):
                     "-c:v",
                     "h264_nvenc",  # "av1_nvenc", "h264_nvenc" "hevc_nvenc"  # TODO: this still requires nvenc to be installed?
                     "-preset",
-                    "p1",
+                    "p1",  # p1 - p7, p1 is fastest (replaces the legacy "fast" / "hp" presets)
+                    "-tune",
+                    "ull",  # Ultra low latency
+                    "-rc",
+                    "constqp",  # Constant quantization, set by -qp
                     "-qp",
                     str(quality),  # Video quality (0-51, lower is better)
                     "-gpu",
                     str(gpu),  # Specify which GPU to use for encoding
+                    # Without these, NVENC buffers ~3-4 frames before emitting any packets
+                    "-delay",
+                    "0",  # Output packets as soon as they're encoded
+                    "-zerolatency",
+                    "1",  # No reordering delay
+                    "-bf",
+                    "0",  # No B-frames, which would need future frames to be encoded first
+                    "-forced-idr",
+                    "1",  # Make forced keyframes IDR frames, so videos can be cut at them
                     "-vsync",
                     "0",  # Disable frame rate synchronization
                     "-2pass",
@@ -665,13 +826,19 @@ class FFMPEG_Writer(BaseWriter):
                     "-crf",
                     str(quality),  # Video quality (0-51, lower is better)
                     "-threads",
-                    "4",  # Number of threads to use for encoding
+                    str(threads),  # Number of threads to use for encoding
                 ]
 
-            if pixel_format not in ["gray16", "gray16"]:
-                command += ["-pix_fmt", "yuv420p"]  # Output pixel format
+            # Output pixel format: NVENC's native nv12 on the GPU, else yuv420p
+            # (the same as the input, when the writer sends frames in these formats,
+            # so ffmpeg doesn't have to convert them)
+            if pixel_format != "gray16":
+                command += ["-pix_fmt", "nv12" if gpu is not None else "yuv420p"]
 
             # Additional options for output format and filename
+            if movflags is not None and str(filename).endswith(".mp4"):
+                command += ["-movflags", movflags]  # MP4 muxer flags
+
             command += [str(filename)]  # Output filename
         else:
             codec = "ffv1"
@@ -688,6 +855,8 @@ class FFMPEG_Writer(BaseWriter):
                 frame_size,
                 "-pix_fmt",
                 pixel_format,
+                "-thread_queue_size",
+                "16",  # Number of input frames to buffer (kept small, as above)
                 "-i",
                 "-",
                 "-an",
@@ -695,12 +864,170 @@ class FFMPEG_Writer(BaseWriter):
                 codec,
                 # "-c:v",
                 # "libx264",
+                "-pix_fmt",
+                pixel_format,  # Store gray frames as they are, with no conversion
+                "-level",
+                "3",  # ffv1 version 3, which can encode slices in parallel
+                "-slices",
+                "24",
+                "-slicecrc",
+                "1",  # Checksum each slice, so corruption can be detected
+                "-threads",
+                str(threads),
+                "-g",
+                "1",  # Every frame is a keyframe, so any frame can be read without the ones before it
                 str(filename),
             ]
 
         return command
 
 
+class PyAV_Writer(BaseWriter):
+    def __init__(
+        self,
+        queue,
+        video_file_name,
+        metadata_file_name,
+        config=None,
+        process_name=None,
+        logger_queue=None,
+        logging_level=logging.DEBUG,
+    ):
+        """Write videos with PyAV, which runs libav's encoders in-process.
+
+        Unlike the FFMPEG_Writer, frames are handed straight to the encoder
+        rather than being copied through a pipe into an ffmpeg subprocess.
+        """
+        super().__init__(
+            queue=queue,
+            video_file_name=video_file_name,
+            metadata_file_name=metadata_file_name,
+            config=config,
+            process_name=process_name,
+            logger_queue=logger_queue,
+            logging_level=logging_level,
+        )
+
+        # PyAV-specific stuff
+        self.container = None
+        self.stream = None
+        self.frames_encoded = 0
+
+    @staticmethod
+    def default_writer_config(fps, vid_type="ir", gpu="auto"):
+        """A default config dict for a PyAV writer.
+
+        Frame size tbd on the fly.
+
+        If gpu is "auto", ir videos are encoded on GPU 0 with NVENC when it's
+        available, and on the CPU otherwise. Pass gpu=None to force CPU encoding.
+        """
+        config = FFMPEG_Writer.default_writer_config(fps, vid_type=vid_type, gpu=gpu)
+        config["type"] = "pyav"
+        return config
+
+    def validate_config(self):
+        # Check pixel format
+        assert "pixel_format" in self.config, "pixel_format must be specified"
+        assert self.config["pixel_format"] in [
+            "gray8",
+            "gray16",
+        ], "PyAV writer only supports gray8 and gray16 pixel formats"
+
+    def _get_new_pipe(self, data_shape):
+        import av
+        from av.video.reformatter import ColorRange
+
+        options = {}
+        if (
+            self.config.get("movflags") is not None
+            and self.video_file_name.suffix == ".mp4"
+        ):
+            options["movflags"] = self.config["movflags"]
+        self.container = av.open(str(self.video_file_name), mode="w", options=options)
+        if self.config["depth"]:
+            # Lossless depth
+            self.stream = self.container.add_stream("ffv1", rate=self.config["fps"])
+            self.stream.pix_fmt = "gray16le"
+            # (see the ffmpeg writer's ffv1 options)
+            self.stream.options = {
+                "level": "3",
+                "slices": "24",
+                "slicecrc": "1",
+                "g": "1",
+            }
+            self.stream.thread_type = "AUTO"
+        elif self.config["gpu"] is not None:
+            self.stream = self.container.add_stream(
+                "h264_nvenc", rate=self.config["fps"]
+            )
+            self.stream.pix_fmt = "nv12"  # NVENC's native format
+            self.stream.options = {
+                "preset": "p1",
+                "tune": "ull",
+                "rc": "constqp",
+                "qp": str(self.config["quality"]),
+                "gpu": str(self.config["gpu"]),
+                "delay": "0",
+                "zerolatency": "1",
+                "bf": "0",
+                "forced-idr": "1",
+            }
+        else:
+            self.stream = self.container.add_stream("libx264", rate=self.config["fps"])
+            self.stream.pix_fmt = "yuv420p"
+            self.stream.options = {
+                "preset": self.config["preset"],
+                "crf": str(self.config["quality"]),
+            }
+        self.stream.width = data_shape[1]
+        self.stream.height = data_shape[0]
+        if not self.config["depth"]:
+            # Gray frames are full range (0-255), not tv range (16-235),
+            # as with the ffmpeg writer's "-color_range pc"
+            self.stream.codec_context.color_range = ColorRange.JPEG
+
+        # The pipe is just a flag for BaseWriter.run() that the encoder is ready
+        self.pipe = self.stream
+        self.frames_encoded = 0
+        self.logger.debug(f"Created PyAV {self.stream.codec_context.name} encoder")
+
+    def append(self, data):
+        import av
+        from av.video.reformatter import ColorRange
+
+        if self.config["pixel_format"] == "gray16":
+            frame = av.VideoFrame.from_ndarray(
+                np.ascontiguousarray(data, dtype=np.uint16), format="gray16le"
+            )
+        else:
+            frame = av.VideoFrame.from_ndarray(
+                np.ascontiguousarray(data, dtype=np.uint8), format="gray"
+            )
+            # (keeping the full range, rather than squeezing luma into 16-235)
+            frame = frame.reformat(
+                format=self.stream.pix_fmt,
+                src_color_range=ColorRange.JPEG,
+                dst_color_range=ColorRange.JPEG,
+            )
+
+        # Timestamps are in units of frames (the stream's time base is 1 / fps)
+        frame.pts = self.frames_encoded
+        self.frames_encoded += 1
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+
+    def close_video(self):
+        if self.container is not None:
+            # Flush the encoder
+            for packet in self.stream.encode():
+                self.container.mux(packet)
+            self.container.close()
+        self.container = None
+        self.stream = None
+        self.pipe = None
+
+
 def get_writer(
     queue,
     video_file_name,
@@ -732,26 +1059,152 @@ def get_writer(
             logger_queue=logger_queue,
             logging_level=logging_level,
         )
+    elif writer_type == "pyav":
+        writer = PyAV_Writer(
+            queue,
+            video_file_name,
+            metadata_file_name,
+            config=config,
+            process_name=process_name,
+            logger_queue=logger_queue,
+            logging_level=logging_level,
+        )
     else:
         raise ValueError(f"Unrecognized writer type: {writer_type}")
     return writer
 
 
-def grey2nv12(frame):
-    """Convert greyscale image to nv12"""
-    # Convert grayscale to Y channel in YUV
-    Y = frame.astype(np.uint8)
+def assign_cpu_sets(writer_configs):
+    """Split the available CPUs between the writers that encode with ffmpeg on the CPU.
+
+    Several libx264 encoders that each use every core contend with each other;
+    giving each its own set of cores (and one encoding thread per core) keeps
+    their throughput predictable. Writers that already have a cpu_set, or that
+    encode on a GPU, are left alone. Does nothing on platforms without CPU
+    affinity (e.g. Windows and macOS), or if there is only one CPU encoder.
+
+    Parameters
+    ----------
+    writer_configs : list of dict
+        The writer configs, which are updated in place.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return
+    cpu_encoders = [
+        config
+        for config in writer_configs
+        if config.get("type") == "ffmpeg"
+        and config.get("gpu") is None
+        and config.get("cpu_set") is None
+    ]
+    if len(cpu_encoders) < 2:
+        return
+
+    # Deal out the CPUs round-robin (or share them, if there are more encoders than CPUs)
+    cpus = sorted(os.sched_getaffinity(0))
+    for i, config in enumerate(cpu_encoders):
+        config["cpu_set"] = cpus[i :: len(cpu_encoders)] or [cpus[i % len(cpus)]]
+
+
+def pin_process(pid, cpu_set):
+    """Restrict a running process, and any threads it has already started, to cpu_set.
+
+    Threads the process starts later inherit the restriction. Does nothing if
+    the process has already exited.
+    """
+    try:
+        # (on Linux, each of a process's threads has its own affinity)
+        thread_ids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        thread_ids = [pid]
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(thread_id, cpu_set)
+        except ProcessLookupError:
+            pass
+
+
+def enlarge_pipe_buffer(pipe_file, size):
+    """Grow the kernel buffer of a pipe (Linux only; a no-op elsewhere).
 
-    # U and V channels are set to 128 (for a grayscale image, chroma channels remain constant)
-    U = np.full((frame.shape[0] // 2, frame.shape[1] // 2), 128, dtype=np.uint8)
-    V = np.full((frame.shape[0] // 2, frame.shape[1] // 2), 128, dtype=np.uint8)
+    Pipes default to 64 KiB, much smaller than a typical frame. The size is
+    capped at /proc/sys/fs/pipe-max-size, the limit for unprivileged processes.
+    """
+    if not sys.platform.startswith("linux"):
+        return
+    import fcntl
+
+    try:
+        with open("/proc/sys/fs/pipe-max-size") as f:
+            size = min(size, int(f.read()))
+    except (OSError, ValueError):
+        pass
+    F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+    try:
+        fcntl.fcntl(pipe_file.fileno(), F_SETPIPE_SZ, size)
+    except OSError:
+        pass
 
-    # Interleave U and V for NV12 format
-    UV = np.empty((U.shape[0], U.shape[1] * 2), dtype=np.uint8)
-    UV[:, 0::2] = U
-    UV[:, 1::2] = V
 
-    # Stack Y and UV to create the NV12 format
-    nv12 = np.vstack((Y, UV))
+def write_buffers(pipe_file, buffers):
+    """Write several buffers to a pipe, with a single gather-write where possible."""
+    if not hasattr(os, "writev"):
+        # (e.g. Windows)
+        for buffer in buffers:
+            pipe_file.write(buffer)
+        return
+
+    pipe_file.flush()
+    fd = pipe_file.fileno()
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+    while buffers:
+        n_written = os.writev(fd, buffers)
+
+        # Drop whatever was written, in case the write was partial
+        while buffers and n_written >= len(buffers[0]):
+            n_written -= len(buffers[0])
+            buffers.pop(0)
+        if buffers:
+            buffers[0] = buffers[0][n_written:]
+
+
+@functools.lru_cache(maxsize=None)
+def nvenc_available():
+    """Check whether ffmpeg can encode with NVENC on this machine.
+
+    Listing ffmpeg's encoders isn't enough (most builds include h264_nvenc even
+    without an NVIDIA GPU), so this encodes a single blank frame. The result
+    is cached, so the check only runs once per process.
+    """
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-f",
+        "lavfi",
+        "-i",
+        "color=black:s=256x256",
+        "-frames:v",
+        "1",
+        "-c:v",
+        "h264_nvenc",
+        "-f",
+        "null",
+        "-",
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+    return result.returncode == 0
 
+
+def grey2nv12(frame):
+    """Convert greyscale image to nv12"""
+    # NV12 is the Y plane followed by a half-height plane of interleaved U and V.
+    # For a grayscale image the chroma channels are constant (128), so both are
+    # filled in one go, and the frame is cast to uint8 as it's copied into the Y plane.
+    height, width = frame.shape[:2]
+    nv12 = np.full((height + height // 2, width), 128, dtype=np.uint8)
+    nv12[:height] = frame
     return nv12